@@ -17,10 +17,12 @@
 # python todocopy.py dbsummary tbvenue,tbtasktype -o db.xml	# Generate database summary of 2 tables and output to .xml file
 
 
-import os, sys, zlib, zipfile, time, dircache, re, datetime, calendar
+import os, sys, zlib, zipfile, time, dircache, re, datetime, calendar, struct, fnmatch, errno
 from optparse import OptionParser
 from time import strftime
 import xml.dom.minidom
+from xml.sax.saxutils import quoteattr
+import threading, Queue, tarfile, subprocess, gzip, tempfile, cStringIO, signal, copy
 
 imports = {}
 # Import optional libraries
@@ -61,6 +63,687 @@ try:
 except:
     pass
 
+try:
+    import hashlib
+    imports['hashlib']=True
+except:
+    pass
+
+try:
+    import fcntl
+    imports['fcntl']=True
+except:
+    pass
+
+try:
+    import ctypes, ctypes.util
+    imports['ctypes']=True
+except:
+    pass
+
+try:
+    import lzma
+    imports['lzma']=True
+except:
+    try:
+        from backports import lzma
+        imports['lzma']=True
+    except:
+        pass
+
+try:
+    import zstandard
+    imports['zstd']=True
+except:
+    pass
+
+try:
+    import paramiko
+    imports['paramiko']=True
+except:
+    pass
+
+
+class workerPool:
+    "Runs jobs on a fixed set of threads and hands the results back in submission order."
+    def __init__(self,threads,maxPending=0):
+        self.threads = max(1,int(threads))
+        # Bound the queue so a huge file list doesn't get queued in memory ahead of the workers
+        if maxPending<1:
+            maxPending = self.threads*4
+        self.jobs = Queue.Queue(maxPending)
+        self.done = {}
+        self.doneLock = threading.Condition()
+        self.nextSubmit = 0
+        self.nextResult = 0
+        self.workers = []
+        for i in range(self.threads):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            (seq,func,args,context) = job
+            try:
+                result = (context,True,func(*args))
+            except Exception, why:
+                result = (context,False,why)
+            self.doneLock.acquire()
+            self.done[seq] = result
+            self.doneLock.notifyAll()
+            self.doneLock.release()
+
+    # Queue func(*args). context is handed back untouched with the result.
+    def submit(self,func,args=(),context=None):
+        self.jobs.put((self.nextSubmit,func,args,context))
+        self.nextSubmit += 1
+
+    # Return the finished (context,ok,value) results that are next in submission order.
+    # With wait set, block until every submitted job has finished.
+    def results(self,wait=False):
+        ready = []
+        self.doneLock.acquire()
+        try:
+            while self.nextResult < self.nextSubmit:
+                if self.nextResult in self.done:
+                    ready.append(self.done.pop(self.nextResult))
+                    self.nextResult += 1
+                elif wait:
+                    self.doneLock.wait()
+                else:
+                    break
+        finally:
+            self.doneLock.release()
+        return ready
+
+    # Wait for all jobs, stop the threads and return the remaining results
+    def close(self):
+        ready = self.results(True)
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        return ready
+
+
+class tokenBucket:
+    "Token bucket rate limiter shared by every thread of a task. rate is units per second."
+    def __init__(self,rate,burst=0):
+        self.rate = float(rate)
+        # Allow up to a second's worth of burst by default
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    # Take amount tokens, sleeping until the bucket has refilled enough to cover them.
+    # The balance may go negative, so concurrent callers queue up behind each other.
+    def consume(self,amount):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.capacity,self.tokens+(now-self.last)*self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = 0
+            if self.tokens<0:
+                wait = -self.tokens/self.rate
+        finally:
+            self.lock.release()
+        if wait>0:
+            time.sleep(wait)
+
+
+class throttledFile:
+    "Write-only file wrapper that calls throttle(byteCount) before each write, to pace a stream such as a tar pipe."
+    def __init__(self,fileObj,throttle):
+        self.fileObj = fileObj
+        self.throttle = throttle
+
+    def write(self,data):
+        self.throttle(len(data))
+        self.fileObj.write(data)
+
+    def flush(self):
+        self.fileObj.flush()
+
+class countingFile:
+    "File wrapper that keeps its position and size in memory, so they never cost a tell or stat syscall."
+    def __init__(self,fileObj):
+        self.fileObj = fileObj
+        self.name = getattr(fileObj,'name','')
+        self.pos = 0
+        self.size = 0
+
+    def write(self,data):
+        self.fileObj.write(data)
+        self.pos += len(data)
+        if self.pos>self.size:
+            self.size = self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seek(self,offset,whence=0):
+        self.fileObj.seek(offset,whence)
+        if whence==0:
+            self.pos = offset
+        elif whence==1:
+            self.pos += offset
+        else:
+            self.pos = self.size+offset
+
+    def flush(self):
+        self.fileObj.flush()
+
+    def close(self):
+        self.fileObj.close()
+
+class uploadError(IOError):
+    "The upload behind an uploadPipe failed, so nothing more can be written to it."
+    pass
+
+class uploadPipe:
+    "Write-only file that hands its data to an upload running on its own thread through a bounded buffer, so writing and uploading overlap."
+    def __init__(self,upload,name='',chunkSize=262144,maxChunks=16):
+        self.name = name
+        self.chunkSize = chunkSize
+        self.chunks = Queue.Queue(maxChunks)
+        self.pending = []
+        self.pendingSize = 0
+        self.buffer = ''
+        self.eof = False
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run,args=(upload,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    # Upload thread: upload reads everything through read(), then the buffer is drained so a
+    # writer blocked on a full buffer goes on even if the upload failed part way
+    def run(self,upload):
+        try:
+            upload(self)
+        except Exception, why:
+            self.error = why
+        while not self.eof:
+            if self.chunks.get() is None:
+                self.eof = True
+
+    def failed(self):
+        return uploadError("upload of %s failed: %s" % (self.name,str(self.error)))
+
+    # Hand a chunk to the upload thread. Returns False instead of blocking for good if the thread has gone.
+    def putChunk(self,chunk):
+        while self.thread.isAlive():
+            try:
+                self.chunks.put(chunk,True,0.5)
+                return True
+            except Queue.Full:
+                pass
+        if not self.error:
+            self.error = "the upload stopped before the end of the file"
+        return False
+
+    # Small writes such as zip headers are gathered into chunks of about chunkSize bytes
+    def write(self,data):
+        if self.error:
+            raise self.failed()
+        self.pending.append(data)
+        self.pendingSize += len(data)
+        if self.pendingSize >= self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.error:
+            raise self.failed()
+        if self.pending:
+            chunk = ''.join(self.pending)
+            self.pending = []
+            self.pendingSize = 0
+            if not self.putChunk(chunk):
+                raise self.failed()
+
+    # Called from the upload thread. Returns '' once the writer has closed the pipe.
+    def read(self,size=-1):
+        while not self.buffer and not self.eof:
+            chunk = self.chunks.get()
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buffer = chunk
+        if size<0:
+            size = len(self.buffer)
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    # Wait for the upload to finish and raise if it failed. Closing again does nothing.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        except uploadError:
+            pass
+        # A failed upload thread is still draining, so the end marker also lets it go
+        self.putChunk(None)
+        self.thread.join()
+        if self.error:
+            raise self.failed()
+
+class ftpPool:
+    "Lends out up to size logged-in FTP connections, opening them on first use and replacing any that drop."
+    def __init__(self,connect,size):
+        self.connect = connect
+        self.idle = Queue.Queue()
+        # Empty slots are connected when first borrowed
+        for i in range(max(1,int(size))):
+            self.idle.put(None)
+
+    # Borrow a connection. It must always be handed back with put, even if connecting failed.
+    def get(self):
+        ftph = self.idle.get()
+        if ftph is None:
+            ftph = self.connect()
+        return ftph
+
+    # Hand a connection back. None frees the slot for a new connection.
+    def put(self,ftph):
+        self.idle.put(ftph)
+
+    # Close a connection that failed. The borrower connects again with connect() if it wants to go on.
+    def drop(self,ftph):
+        if ftph is not None:
+            try:
+                ftph.close()
+            except ftplib.all_errors:
+                pass
+
+    def close(self):
+        while True:
+            try:
+                ftph = self.idle.get_nowait()
+            except Queue.Empty:
+                break
+            if ftph is not None:
+                try:
+                    ftph.quit()
+                except ftplib.all_errors:
+                    ftph.close()
+
+class execResult:
+    "Outcome of a command run by runCommand: its exit code (negative for a signal), whether it timed out or was cancelled, and any captured lines."
+    def __init__(self,cmd):
+        self.cmd = cmd
+        self.exitCode = None
+        self.timedOut = False
+        self.cancelled = False
+        self.lines = []
+
+    def ok(self):
+        return self.exitCode == 0 and not self.timedOut and not self.cancelled
+
+    def __str__(self):
+        if self.timedOut:
+            return "timed out"
+        if self.cancelled:
+            return "cancelled"
+        if self.exitCode < 0:
+            return "killed by signal "+str(-self.exitCode)
+        return "exit status "+str(self.exitCode)
+
+class threadOutput:
+    "Stands in for sys.stdout while tasks run on threads. Each line a task writes gets the task's prefix, or with hold set the task's output is kept in a temp file and written in one piece when it ends."
+    def __init__(self,stream):
+        self.stream = stream
+        self.softspace = 0
+        self.lock = threading.Lock()
+        self.prefixes = {}
+        self.partial = {}
+        self.held = {}
+
+    def prefix(self):
+        return self.prefixes.get(threading.currentThread(),'')
+
+    def begin(self,prefix,hold=False):
+        thread = threading.currentThread()
+        self.prefixes[thread] = prefix
+        self.partial[thread] = ''
+        if hold:
+            self.held[thread] = tempfile.TemporaryFile()
+
+    def end(self,header=''):
+        thread = threading.currentThread()
+        if self.partial.get(thread):
+            self.write('\n')
+        heldFile = self.held.pop(thread,None)
+        if heldFile:
+            heldFile.seek(0)
+            self.lock.acquire()
+            try:
+                self.stream.write(header)
+                while True:
+                    block = heldFile.read(65536)
+                    if not block:
+                        break
+                    self.stream.write(block)
+                self.stream.flush()
+            finally:
+                self.lock.release()
+            heldFile.close()
+        self.prefixes.pop(thread,None)
+        self.partial.pop(thread,None)
+
+    def write(self,text):
+        thread = threading.currentThread()
+        if thread not in self.prefixes:
+            self.lock.acquire()
+            try:
+                self.stream.write(text)
+            finally:
+                self.lock.release()
+            return
+        lines = (self.partial[thread]+text).split('\n')
+        self.partial[thread] = lines.pop()
+        if not lines:
+            return
+        if thread in self.held:
+            self.held[thread].write('\n'.join(lines)+'\n')
+            return
+        prefix = self.prefixes[thread]
+        self.lock.acquire()
+        try:
+            for line in lines:
+                self.stream.write(prefix+line+'\n')
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.stream.flush()
+
+class crcFile:
+    "Read-only file wrapper that computes the CRC32 of everything read through it."
+    def __init__(self,fileObj):
+        self.fileObj = fileObj
+        self.crc = 0
+
+    def read(self,size=-1):
+        data = self.fileObj.read(size)
+        self.crc = zlib.crc32(data,self.crc) & 0xffffffff
+        return data
+
+
+# Member name for a file: arcname or the file's own path, without drive or leading slashes
+def archiveName(inPath,arcname=None):
+    if arcname is None:
+        arcname = inPath
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname
+
+class archiveWriter:
+    "Writes split zip volumes (name_0.zip, name_1.zip, ...) and tracks their size in memory so a volume never grows past volumeSize."
+    def __init__(self,basePath,volumeSize=0,volumeList=None,level=zlib.Z_DEFAULT_COMPRESSION,opener=None):
+        self.basePath = basePath
+        # opener(name) returns the file a volume is written to. Without seek (such as an uploadPipe) members
+        # are written with data descriptors instead of going back to patch their headers.
+        if opener is None:
+            opener = lambda name: open(name,'wb')
+        self.opener = opener
+        self.volumeSize = volumeSize
+        if volumeList is None:
+            volumeList = []
+        self.volumeList = volumeList
+        self.level = level
+        self.volumeInc = 0
+        self.volumeOpen = False
+        self.openVolume()
+
+    # Volumes that are only streamed (such as to FTP) have no local file, so they aren't added to volumeList
+    def openVolume(self):
+        self.curName = self.basePath+"_"+str(self.volumeInc)+".zip"
+        rawFile = self.opener(self.curName)
+        self.streamed = not hasattr(rawFile,'seek')
+        self.fp = countingFile(rawFile)
+        self.zipFile = zipfile.ZipFile(self.fp,'w',zipfile.ZIP_DEFLATED,True)
+        self.volumeOpen = True
+        # The end of central directory record is always written
+        self.centralSize = 22
+        if not self.streamed:
+            self.volumeList.append(self.curName)
+
+    # Close the volume once, even if writing its central directory fails
+    def closeVolume(self):
+        if not self.volumeOpen:
+            return
+        self.volumeOpen = False
+        try:
+            self.zipFile.close()
+        finally:
+            self.fp.close()
+
+    def close(self):
+        self.closeVolume()
+
+    # Give up on the current volume after a failed write, releasing its file or upload
+    def abort(self):
+        if self.volumeOpen:
+            self.volumeOpen = False
+            try:
+                self.fp.close()
+            except (IOError, os.error):
+                pass
+
+    # Size the current volume would have if it were closed now
+    def size(self):
+        total = self.fp.size+self.centralSize
+        # Zip64 end of central directory record and locator
+        if len(self.zipFile.filelist)>=zipfile.ZIP_FILECOUNT_LIMIT or self.fp.size>zipfile.ZIP64_LIMIT:
+            total += 76
+        return total
+
+    # Worst case for the stored size of a member's data (zlib's deflateBound for raw deflate)
+    def maxDataSize(self,fileSize,compressType):
+        if compressType == zipfile.ZIP_DEFLATED:
+            return fileSize+(fileSize>>12)+(fileSize>>14)+(fileSize>>25)+13
+        return fileSize
+
+    # Move on to the next volume unless a member named arcname with up to maxData bytes of data
+    # is sure to fit in this one. An empty volume takes the member however large it is.
+    def makeRoom(self,arcname,maxData):
+        if not self.volumeSize or not self.zipFile.filelist:
+            return
+        # Local header, data descriptor and central directory entry, allowing for zip64 extra fields
+        needed = 30+len(arcname)+20+maxData+24+46+len(arcname)+28
+        if self.size()+needed > self.volumeSize:
+            self.closeVolume()
+            self.volumeInc += 1
+            self.openVolume()
+
+    # ZipInfo for a file, named the way ZipFile.write names it
+    def zipInfo(self,inPath,arcname,fileStat,compressType):
+        zinfo = zipfile.ZipInfo(archiveName(inPath,arcname),time.localtime(fileStat.st_mtime)[0:6])
+        zinfo.external_attr = (fileStat.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = compressType
+        zinfo.file_size = fileStat.st_size
+        return zinfo
+
+    # Add a file the way ZipFile.write does, but from the caller's stat result and with the volume size kept current
+    def addFile(self,inPath,arcname=None,compressType=zipfile.ZIP_DEFLATED,fileStat=None):
+        if fileStat is None:
+            fileStat = os.stat(inPath)
+        zinfo = self.zipInfo(inPath,arcname,fileStat,compressType)
+        self.makeRoom(zinfo.filename,self.maxDataSize(zinfo.file_size,compressType))
+        inFile = open(inPath,'rb')
+        try:
+            zinfo.flag_bits = 0x00
+            if self.streamed:
+                # CRC and sizes follow the data in a data descriptor
+                zinfo.flag_bits = 0x08
+            zinfo.header_offset = self.fp.tell()
+            zinfo.CRC = crc = 0
+            zinfo.compress_size = compressSize = 0
+            zip64 = zinfo.file_size*1.05 > zipfile.ZIP64_LIMIT
+            self.fp.write(zinfo.FileHeader(zip64))
+            compressor = None
+            if compressType == zipfile.ZIP_DEFLATED:
+                compressor = zlib.compressobj(self.level,zlib.DEFLATED,-15)
+            fileSize = 0
+            while True:
+                block = inFile.read(1048576)
+                if not block:
+                    break
+                fileSize += len(block)
+                crc = zlib.crc32(block,crc) & 0xffffffff
+                if compressor:
+                    block = compressor.compress(block)
+                compressSize += len(block)
+                self.fp.write(block)
+            if compressor:
+                block = compressor.flush()
+                compressSize += len(block)
+                self.fp.write(block)
+        finally:
+            inFile.close()
+        zinfo.CRC = crc
+        zinfo.file_size = fileSize
+        zinfo.compress_size = compressSize
+        if self.streamed:
+            if zip64:
+                self.fp.write(struct.pack("<4sLQQ","PK\x07\x08",crc,compressSize,fileSize))
+            else:
+                self.fp.write(struct.pack("<4sLLL","PK\x07\x08",crc,compressSize,fileSize))
+            self.addToDirectory(zinfo)
+            return zinfo
+        # Go back and fill in the CRC and sizes
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset,0)
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.seek(position,0)
+        self.addToDirectory(zinfo)
+        return zinfo
+
+    # Read and compress a whole file in memory, returning (crc, size, data). It touches no writer
+    # state, so it can run on a worker thread; zlib releases the GIL while it compresses.
+    def compressFile(self,inPath,compressType=zipfile.ZIP_DEFLATED):
+        crc = 0
+        fileSize = 0
+        chunks = []
+        compressor = None
+        if compressType == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(self.level,zlib.DEFLATED,-15)
+        inFile = open(inPath,'rb')
+        try:
+            while True:
+                block = inFile.read(1048576)
+                if not block:
+                    break
+                fileSize += len(block)
+                crc = zlib.crc32(block,crc) & 0xffffffff
+                if compressor:
+                    block = compressor.compress(block)
+                chunks.append(block)
+        finally:
+            inFile.close()
+        if compressor:
+            chunks.append(compressor.flush())
+        return (crc,fileSize,''.join(chunks))
+
+    # Add a member compressed by compressFile. Its sizes are known, so the header is written once.
+    def addCompressed(self,inPath,arcname,compressType,fileStat,compressed):
+        (crc,fileSize,data) = compressed
+        zinfo = self.zipInfo(inPath,arcname,fileStat,compressType)
+        zinfo.CRC = crc
+        zinfo.file_size = fileSize
+        zinfo.compress_size = len(data)
+        self.makeRoom(zinfo.filename,len(data))
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+        self.fp.write(zinfo.FileHeader())
+        self.fp.write(data)
+        self.addToDirectory(zinfo)
+        return zinfo
+
+    # Register a written member so ZipFile.close puts it in the central directory
+    def addToDirectory(self,zinfo):
+        self.zipFile.filelist.append(zinfo)
+        self.zipFile.NameToInfo[zinfo.filename] = zinfo
+        self.centralSize += 46+len(zinfo.filename)+len(zinfo.extra)+len(zinfo.comment)
+        if zinfo.file_size>zipfile.ZIP64_LIMIT or zinfo.compress_size>zipfile.ZIP64_LIMIT or zinfo.header_offset>zipfile.ZIP64_LIMIT:
+            self.centralSize += 28
+
+
+class tarWriter:
+    "Writes a compressed tar stream (name.tar.gz, name.tar.xz or name.tar.zst) one member at a time without keeping a member list."
+    # Default compression level for each format
+    levels = {'tar.gz':6,'tar.xz':6,'tar.zst':3}
+    def __init__(self,basePath,format='tar.gz',volumeList=None,level=None,opener=None):
+        if level is None:
+            level = self.levels[format]
+        self.curName = basePath+"."+format
+        if opener is None:
+            opener = lambda name: open(name,'wb')
+        self.rawFile = opener(self.curName)
+        try:
+            if format == 'tar.gz':
+                self.fp = gzip.GzipFile(os.path.basename(basePath)+".tar",'wb',level,self.rawFile)
+            elif format == 'tar.xz':
+                self.fp = lzma.LZMAFile(self.rawFile,'wb',preset=level)
+            else:
+                self.fp = zstandard.ZstdCompressor(level=level).stream_writer(self.rawFile)
+            self.tarFile = tarfile.open(fileobj=self.fp,mode='w|',bufsize=1048576)
+        except:
+            try:
+                self.rawFile.close()
+            except IOError:
+                pass
+            raise
+        # A stream with no local file (such as an FTP upload) isn't added to volumeList
+        if volumeList is not None and hasattr(self.rawFile,'seek'):
+            volumeList.append(self.curName)
+
+    # Add a file from the caller's stat result. The member isn't kept, so memory stays flat for any number of files.
+    def addFile(self,inPath,arcname=None,compressType=None,fileStat=None):
+        if fileStat is None:
+            fileStat = os.stat(inPath)
+        tinfo = tarfile.TarInfo(archiveName(inPath,arcname))
+        tinfo.size = fileStat.st_size
+        tinfo.mtime = int(fileStat.st_mtime)
+        tinfo.mode = fileStat.st_mode & 07777
+        tinfo.uid = fileStat.st_uid
+        tinfo.gid = fileStat.st_gid
+        inFile = open(inPath,'rb')
+        try:
+            reader = crcFile(inFile)
+            self.tarFile.addfile(tinfo,reader)
+        finally:
+            inFile.close()
+        self.tarFile.members = []
+        # Same attribute name as ZipInfo, so callers can read the CRC from either writer
+        tinfo.CRC = reader.crc
+        return tinfo
+
+    def close(self):
+        try:
+            self.tarFile.close()
+            self.fp.close()
+        finally:
+            self.rawFile.close()
+
+    # Give up on the stream after a failed write, releasing its file or upload
+    def abort(self):
+        try:
+            self.rawFile.close()
+        except (IOError, os.error):
+            pass
 
 class todocopy:
     "Todo Copy will copy, zip,and FTP file backups. It can be commanded directly or through a batch file."
@@ -70,7 +753,21 @@ class todocopy:
     curZip = None
     curZipInc = 0
     ignoreSVN = True
-    exclusionList = ("jpg","ppt","gif","mov","avi","mp3","swf")
+    # Extensions of files that are already compressed and are stored in zips rather than deflated.
+    # The storeext attribute or property adds more (comma separated).
+    exclusionList = ("jpg","jpeg","png","gif","webp","heic","mov","avi","mp4","m4v","mkv","webm","wmv","flv",
+        "mp3","m4a","aac","ogg","oga","opus","flac","wma","swf","zip","gz","tgz","bz2","tbz","xz","txz","zst",
+        "lz","lzma","7z","rar","cab","jar","war","apk","deb","rpm","docx","xlsx","pptx","odt","ods","odp","epub","ppt")
+    # Magic bytes of compressed formats as (offset, bytes), for files whose extension doesn't give them away
+    storeMagic = ((0,'PK\x03\x04'),(0,'\x1f\x8b'),(0,'BZh'),(0,'\xfd7zXZ\x00'),(0,'\x28\xb5\x2f\xfd'),
+        (0,'7z\xbc\xaf\x27\x1c'),(0,'Rar!'),(0,'\x89PNG'),(0,'\xff\xd8\xff'),(0,'GIF8'),(8,'WEBP'),
+        (4,'ftyp'),(0,'OggS'),(0,'fLaC'),(0,'ID3'),(0,'\x1aE\xdf\xa3'))
+    storeExt = ()
+    # Files smaller than this are always deflated; sampling them would cost more than it saves
+    storeSampleMin = 4096
+    storeSampleSize = 65536
+    storeGain = 5
+    storeTest = True
     archiveList = []
     examples = []
     cmdOptions = None
@@ -89,9 +786,41 @@ class todocopy:
     commandList = {}
     fileLists = {}
     targetList = {}
+    # Targets already run by runTargets (name: True, or False if it failed or was skipped)
+    targetsRun = {}
     basePath = ""
     reportInc = 0
     mysqlconn = None
+    copyPool = None
+    copyErrors = 0
+    zipPool = None
+    # Archive manifest state for zip mode='full|incremental|differential', None when not in use
+    zipManifest = None
+    ftpStream = None
+    # Set to stop the commands run by runCommand
+    cancelEvent = threading.Event()
+    ftpBlockSize = 65536
+    ftpRetries = 3
+    ftpRetryWait = 2
+    ftpResume = False
+    # Members larger than this are streamed by the writer thread instead of compressed in memory by the pool
+    zipInlineSize = 32*1048576
+    madeDirs = {}
+    absPaths = {}
+    deltaCopy = False
+    deltaBlockSize = 1048576
+    deltaStats = {'checked':0,'written':0}
+    statsLock = threading.Lock()
+    byteLimiter = None
+    fileLimiter = None
+    ioPriority = ''
+    journal = None
+    journalName = ".tc_journal"
+    journalDone = {}
+    journalPartial = {}
+    journalSkipped = 0
+    libc = None
+    manifestName = ".tc_manifest.xml"
 
     def __init__(self):
         self.data = []
@@ -133,7 +862,27 @@ class todocopy:
 
     # Test the passed file to see if the three letter file extension is in the exclusion list
     def testExtension(self,inFile):
-        return inFile[-3:].lower() in self.exclusionList
+        ext = os.path.splitext(inFile)[1][1:].lower()
+        return ext in self.exclusionList or ext in self.storeExt
+
+    # True if a file looks already compressed, so storing it beats deflating it: by extension, by the magic
+    # bytes at its start, or when a fast test compression of its first 64 KB gains less than storegain percent
+    def testCompressed(self,inPath,fileSize):
+        if self.testExtension(inPath):
+            return True
+        if fileSize < self.storeSampleMin:
+            return False
+        f = open(inPath,'rb')
+        try:
+            head = f.read(self.storeSampleSize)
+        finally:
+            f.close()
+        for offset,magic in self.storeMagic:
+            if head[offset:offset+len(magic)] == magic:
+                return True
+        if not self.storeTest or not head:
+            return False
+        return len(zlib.compress(head,1))*100 > len(head)*(100-self.storeGain)
 
     # For status output, all messages are passed here and then based on user preferences,
     # different levels of output are used.
@@ -158,66 +907,626 @@ class todocopy:
         # 4 = Report most
         elif self.reportLevel<5:
             print inStr
+    # Cached os.path.abspath -- for a relative path abspath calls getcwd, which is a syscall every time
+    def absPath(self,inPath):
+        if inPath not in self.absPaths:
+            self.absPaths[inPath] = os.path.abspath(inPath)
+        return self.absPaths[inPath]
     def relativePath(self,basePath,srcPath):
         outPath = srcPath
-        bpLen = len(self.basePath)
+        bpLen = len(basePath)
         if bpLen>0:
-            # If paths are the same, remove base path
-            if os.path.abspath(srcPath[0:bpLen])==os.path.abspath(basePath):
+            # If paths are the same, remove base path. Paths from os.walk start with the base path
+            # itself, so the string compare usually settles it without resolving anything.
+            prefix = srcPath[0:bpLen]
+            if prefix==basePath or os.path.abspath(prefix)==self.absPath(basePath):
                 # Shave off the preceding slash
                 if srcPath[bpLen:bpLen+1] == '/' or srcPath[bpLen:bpLen+1] == '\\':
                     bpLen += 1
                 return srcPath[bpLen:]
         return srcPath
 
-    def copyFile(self, inPath,destPath):
-        success = False
-        (srcPath,fileName) = os.path.split(inPath)
-        outPath = os.path.join(destPath,srcPath)
-        bpLen = len(self.basePath)
-        if bpLen>0:
-            # If paths are the same, remove base path
-            if os.path.abspath(srcPath[0:bpLen])==os.path.abspath(self.basePath):
-                outPath = os.path.join(destPath,srcPath[bpLen:])
+    # Destination path of a copied file: the base path is stripped so it lands below destPath with its relative directories
+    def copyDestPath(self,inPath,destPath):
+        return os.path.join(destPath,self.relativePath(self.basePath,inPath))
+
+    # Create a destination directory unless this copy task already has. Directories are
+    # remembered so a tree of small files costs one stat per directory rather than per file.
+    def makeDestDir(self,outPath):
+        if not outPath or outPath in self.madeDirs:
+            return
+        if not os.path.isdir(outPath):
+            try:
+                os.makedirs(outPath)
+            except os.error:
+                # Another copy thread may have created it first
+                if not os.path.isdir(outPath):
+                    raise
+        self.madeDirs[outPath] = 1
+
+    # Copy one file, creating its directory if needed. Raises on error so it can run on a copy pool thread.
+    def copyFileTo(self,inPath,dest):
+        self.throttleFiles()
+        self.makeDestDir(os.path.dirname(dest))
+        if self.journal:
+            return self.journalCopyFile(inPath,dest)
+        # In delta mode a large existing destination is updated in place rather than rewritten
+        if self.deltaCopy and os.path.isfile(dest) and os.path.getsize(dest)>=self.deltaBlockSize:
+            self.deltaCopyFile(inPath,dest)
+        else:
+            self.copyFileData(inPath,dest)
+        return dest
+
+    # Compare the source and the existing destination block by block and write only the blocks
+    # that differ, then trim the destination to the source size. Both files are local, so the
+    # blocks are compared directly instead of through rolling checksums.
+    def deltaCopyFile(self,inPath,dest):
+        blockSize = self.deltaBlockSize
+        checked = 0
+        written = 0
+        srcFile = open(inPath,'rb')
+        try:
+            destFile = open(dest,'r+b')
+            try:
+                offset = 0
+                srcBlock = srcFile.read(blockSize)
+                while srcBlock:
+                    self.throttleBytes(len(srcBlock))
+                    destBlock = destFile.read(len(srcBlock))
+                    if destBlock != srcBlock:
+                        destFile.seek(offset)
+                        destFile.write(srcBlock)
+                        written += len(srcBlock)
+                    checked += len(srcBlock)
+                    offset += len(srcBlock)
+                    # Reposition between the read and the next write, as C stdio requires
+                    destFile.seek(offset)
+                    srcBlock = srcFile.read(blockSize)
+                destFile.truncate(offset)
+            finally:
+                destFile.close()
+        finally:
+            srcFile.close()
+        self.statsLock.acquire()
+        self.deltaStats['checked'] += checked
+        self.deltaStats['written'] += written
+        self.statsLock.release()
+        return written
+
+    # Copy the contents of inPath to dest. On Linux the data is moved inside the kernel (reflink clone,
+    # copy_file_range or sendfile) and only falls back to copying through Python buffers when none applies.
+    # Set the property fastcopy to 0 to always use the buffered copy.
+    def copyFileData(self,inPath,dest):
+        useKernel = self.curOS()=='linux' and self.attrFlag(self.props,'fastcopy',1)
+        if not useKernel and not self.byteLimiter:
+            shutil.copyfile(inPath,dest)
+            return
+        if hasattr(os.path,'samefile') and os.path.exists(dest) and os.path.samefile(inPath,dest):
+            raise shutil.Error("`%s` and `%s` are the same file" % (inPath, dest))
+        srcFile = open(inPath,'rb')
+        try:
+            destFile = open(dest,'wb')
+            try:
+                if not (useKernel and self.kernelCopy(srcFile,destFile)):
+                    srcFile.seek(0)
+                    destFile.seek(0)
+                    destFile.truncate()
+                    self.copyFileObj(srcFile,destFile)
+            finally:
+                destFile.close()
+        finally:
+            srcFile.close()
+
+    # shutil.copyfileobj with the byte rate limit applied to every block
+    def copyFileObj(self,srcFile,destFile,blockSize=1048576):
+        while True:
+            block = srcFile.read(blockSize)
+            if not block:
+                break
+            destFile.write(block)
+            self.throttleBytes(len(block))
+
+    # Set up the rate limits for a copy, zip or ftp task from its attributes or <property> values:
+    # maxbytespersec (K/M/G suffixes allowed), maxfilespersec and ionice (idle or low)
+    def setThrottle(self,inAttr):
+        maxBytes = self.sizeValue(inAttr.get('maxbytespersec',self.props.get('maxbytespersec',0)))
+        maxFiles = inAttr.get('maxfilespersec',self.props.get('maxfilespersec',0))
+        self.byteLimiter = None
+        self.fileLimiter = None
+        if maxBytes>0:
+            self.byteLimiter = tokenBucket(maxBytes)
+        try:
+            if float(maxFiles)>0:
+                self.fileLimiter = tokenBucket(float(maxFiles))
+        except (TypeError, ValueError):
+            print "Invalid maxfilespersec:"+str(maxFiles)
+        ioPriority = inAttr.get('ionice',self.props.get('ionice',''))
+        if ioPriority and ioPriority != self.ioPriority:
+            self.setIOPriority(ioPriority)
+
+    def throttleBytes(self,byteCount):
+        if self.byteLimiter:
+            self.byteLimiter.consume(byteCount)
+
+    def throttleFiles(self):
+        if self.fileLimiter:
+            self.fileLimiter.consume(1)
+
+    # Lower the I/O priority of this process so backups don't compete with production requests.
+    # idle only gets disk time nobody else wants; low is the lowest best-effort level.
+    def setIOPriority(self,ioPriority):
+        self.ioPriority = ioPriority
+        if self.curOS()!='linux':
+            return
+        if ioPriority=='idle':
+            ioClass = " -c 3"
+        elif ioPriority=='low':
+            ioClass = " -c 2 -n 7"
+        else:
+            print "Unknown ionice value (use idle or low):"+ioPriority
+            return
+        self.execStream("ionice"+ioClass+" -p "+str(os.getpid()))
+
+    # Convert a size such as 600M, 4k or 2G (powers of 1024) to bytes
+    def sizeValue(self,value,default=0):
+        value = str(value).strip().upper()
+        multiplier = 1
+        if value[-1:] in ('K','M','G'):
+            multiplier = {'K':1024,'M':1048576,'G':1073741824}[value[-1]]
+            value = value[:-1]
+        try:
+            return int(float(value)*multiplier)
+        except ValueError:
+            return default
+
+    # Load the C library once for the kernel copy calls
+    def getLibc(self):
+        if todocopy.libc is None:
+            todocopy.libc = False
+            if 'ctypes' in imports:
+                try:
+                    libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+                    libc.sendfile.argtypes = [ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t]
+                    libc.sendfile.restype = ctypes.c_ssize_t
+                    if hasattr(libc,'copy_file_range'):
+                        libc.copy_file_range.argtypes = [ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_uint]
+                        libc.copy_file_range.restype = ctypes.c_ssize_t
+                    todocopy.libc = libc
+                except (OSError, AttributeError):
+                    pass
+        return todocopy.libc
 
-        src = os.path.join(srcPath,fileName)
-        dest = os.path.join(destPath,srcPath,fileName)
+    # Try the kernel-side copy methods in order of preference. Returns False if none of them is
+    # supported for this pair of files, in which case nothing has been written yet.
+    def kernelCopy(self,srcFile,destFile):
+        srcFd = srcFile.fileno()
+        destFd = destFile.fileno()
+        # A reflink shares the data blocks on copy-on-write filesystems, so nothing is copied at all
+        if 'fcntl' in imports:
+            FICLONE = 0x40049409
+            try:
+                fcntl.ioctl(destFd,FICLONE,srcFd)
+                return True
+            except (IOError, OSError):
+                pass
+        libc = self.getLibc()
+        if not libc:
+            return False
+        remaining = os.fstat(srcFd).st_size
+        # Files such as those in /proc report a size of 0 but still have content, so they are read the usual way
+        if remaining==0:
+            return False
+        # When throttled, move the data in small enough pieces for the rate limiter to pace them
+        chunkSize = 0x40000000
+        if self.byteLimiter:
+            chunkSize = 1048576
+        methods = []
+        if hasattr(libc,'copy_file_range'):
+            methods.append(lambda count: libc.copy_file_range(srcFd,None,destFd,None,count,0))
+        methods.append(lambda count: libc.sendfile(destFd,srcFd,None,count))
+        # Errors that mean "not supported here" rather than a real I/O failure
+        unsupported = (errno.ENOSYS,errno.EXDEV,errno.EINVAL,errno.EOPNOTSUPP,errno.EBADF)
+        for method in methods:
+            copied = 0
+            while True:
+                sent = method(min(remaining-copied,chunkSize))
+                if sent<0:
+                    err = ctypes.get_errno()
+                    if copied==0 and err in unsupported:
+                        break
+                    raise IOError(err,os.strerror(err))
+                if sent==0 and copied==0:
+                    # Nothing moved at all (some special files), so leave it to the buffered copy
+                    return False
+                copied += sent
+                self.throttleBytes(sent)
+                # A file truncated while it is copied ends the copy early
+                if sent==0 or copied>=remaining:
+                    return True
+        return False
+
+    # Copy a file, or queue it on the copy pool when one is running. onSuccess is called
+    # once the copy has completed, always from the main thread. Pass dest when the caller
+    # has already worked out the destination file.
+    def copyFile(self, inPath,destPath,onSuccess=None,dest=None):
+        success = False
+        src = inPath
+        if dest is None:
+            dest = self.copyDestPath(inPath,destPath)
         self.report("Copying file:" + src+ " to: "+dest)
+        if self.copyPool:
+            self.copyPool.submit(self.copyFileTo,(src,dest),(src,dest,onSuccess))
+            self.copyPoolResults()
+            return True
         try:
-            if not os.path.isdir(outPath):
-                os.makedirs(outPath)
-            shutil.copyfile(src,os.path.join(outPath,fileName))
+            self.copyFileTo(src,dest)
             success = True
+            if onSuccess:
+                onSuccess()
         except (IOError, os.error), why:
             print "Can't copy %s to %s: %s" % (src, dest, str(why))
+            self.copyErrors += 1
         return success
 
+    # With resume on, a journal in the destination records every finished file, and files
+    # are written under a temporary name and renamed into place. A rerun after an interruption
+    # skips the finished files and appends to a partial file if its source hasn't changed.
+    def openJournal(self,inArgs):
+        self.journal = None
+        self.journalDone = {}
+        self.journalPartial = {}
+        self.journalSkipped = 0
+        if not self.attrFlag(inArgs,'resume'):
+            return
+        journalPath = os.path.join(inArgs['dest'],self.journalName)
+        if os.path.isfile(journalPath):
+            try:
+                f = open(journalPath,'rb')
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if fields[0]=='D' and len(fields)==4:
+                        self.journalDone[fields[3]] = (int(fields[1]),float(fields[2]))
+                    elif fields[0]=='P' and len(fields)==4:
+                        self.journalPartial[fields[3]] = (int(fields[1]),float(fields[2]))
+                f.close()
+                print "Resuming from journal with "+str(len(self.journalDone))+" files already copied"
+            except (IOError, os.error, ValueError), why:
+                print "Can't read journal %s: %s" % (journalPath,str(why))
+        try:
+            self.makeDestDir(inArgs['dest'])
+            self.journal = open(journalPath,'ab')
+        except (IOError, os.error), why:
+            print "Can't write journal %s: %s" % (journalPath,str(why))
+
+    def journalWrite(self,line):
+        self.statsLock.acquire()
+        try:
+            self.journal.write(line+"\n")
+            self.journal.flush()
+        finally:
+            self.statsLock.release()
+
+    # Journaled copy of one file: skip it if a previous run finished it and the source still has the
+    # size and mtime it had then, otherwise copy to a .tcpart file and rename it over the destination once complete
+    def journalCopyFile(self,inPath,dest):
+        fileStat = os.stat(inPath)
+        if self.journalDone.get(dest)==(fileStat.st_size,fileStat.st_mtime) and os.path.isfile(dest):
+            self.statsLock.acquire()
+            self.journalSkipped += 1
+            self.statsLock.release()
+            return dest
+        # Delta mode already updates the destination in place, so it needs no temporary file
+        if self.deltaCopy and os.path.isfile(dest) and os.path.getsize(dest)>=self.deltaBlockSize:
+            self.deltaCopyFile(inPath,dest)
+        else:
+            partPath = dest+".tcpart"
+            partSize = 0
+            if self.journalPartial.get(dest)==(fileStat.st_size,fileStat.st_mtime) and os.path.isfile(partPath):
+                partSize = os.path.getsize(partPath)
+            self.journalWrite("P\t"+str(fileStat.st_size)+"\t"+repr(fileStat.st_mtime)+"\t"+dest)
+            if partSize>0 and partSize<=fileStat.st_size:
+                # The source is unchanged since the interrupted run, so only the rest is copied
+                srcFile = open(inPath,'rb')
+                try:
+                    srcFile.seek(partSize)
+                    partFile = open(partPath,'ab')
+                    try:
+                        self.copyFileObj(srcFile,partFile)
+                    finally:
+                        partFile.close()
+                finally:
+                    srcFile.close()
+            else:
+                self.copyFileData(inPath,partPath)
+            try:
+                os.rename(partPath,dest)
+            except os.error:
+                # Windows won't rename over an existing file
+                os.remove(dest)
+                os.rename(partPath,dest)
+        self.journalWrite("D\t"+str(fileStat.st_size)+"\t"+repr(fileStat.st_mtime)+"\t"+dest)
+        return dest
+
+    # Close the journal. It is only removed when every file was copied; otherwise the next run resumes.
+    def closeJournal(self):
+        journalPath = self.journal.name
+        self.journal.close()
+        self.journal = None
+        if self.journalSkipped:
+            print "\nResume skipped "+str(self.journalSkipped)+" files finished by the previous run"
+        if not self.copyErrors:
+            try:
+                os.remove(journalPath)
+            except (IOError, os.error):
+                pass
+
+    # Reset the per-task copy state and start a copy pool when the task asks for more than one
+    # thread (threads attribute, property or --jobs)
+    def beginCopyTask(self,inArgs):
+        self.copyErrors = 0
+        self.madeDirs = {}
+        self.absPaths = {}
+        self.deltaCopy = self.attrFlag(inArgs,'delta')
+        self.deltaBlockSize = max(4096,self.attrInt(inArgs,'deltablocksize',1048576))
+        self.deltaStats = {'checked':0,'written':0}
+        self.setThrottle(inArgs)
+        threads = self.attrInt(inArgs,'threads',1)
+        if threads>1:
+            self.copyPool = workerPool(threads)
+
+    # Report finished pool copies in the order they were queued
+    def copyPoolResults(self,wait=False):
+        if wait:
+            results = self.copyPool.close()
+            self.copyPool = None
+        else:
+            results = self.copyPool.results()
+        for (src,dest,onSuccess),ok,why in results:
+            if ok:
+                if onSuccess:
+                    onSuccess()
+            else:
+                print "Can't copy %s to %s: %s" % (src, dest, str(why))
+                self.copyErrors += 1
+
+    def endCopyTask(self):
+        if self.copyPool:
+            self.copyPoolResults(True)
+        if self.journal:
+            self.closeJournal()
+        if self.deltaStats['checked']:
+            print "\nDelta copy rewrote "+str(self.deltaStats['written'])+" of "+str(self.deltaStats['checked'])+" bytes"
+
+    # CRC32 of the file contents, read in blocks so large files don't have to fit in memory
+    def fileCRC(self,inPath,blockSize=1048576):
+        crc = 0
+        f = open(inPath,'rb')
+        try:
+            block = f.read(blockSize)
+            while block:
+                crc = zlib.crc32(block,crc)
+                block = f.read(blockSize)
+        finally:
+            f.close()
+        return "%08x" % (crc & 0xffffffff)
+
+    # Manifest entries are keyed by relative path with '/' separators so they are portable between OSes
+    def manifestKey(self,relPath):
+        return relPath.replace(os.sep,'/')
+
+    # Build the manifest entry for a file and report whether it differs from the previous entry.
+    # Size and mtime decide; with checksum on, a file that was only touched keeps its old entry.
+    # With fillCRC off a changed file's crc is left empty for a caller that computes it while reading the file anyway.
+    def manifestEntry(self,inPath,oldEntry=None,checksum=False,fileStat=None,fillCRC=True):
+        if fileStat is None:
+            fileStat = os.stat(inPath)
+        entry = {'size':fileStat.st_size,'mtime':fileStat.st_mtime,'crc':''}
+        if oldEntry and oldEntry['size']==entry['size']:
+            if oldEntry['mtime']==entry['mtime']:
+                entry['crc'] = oldEntry['crc']
+                return (entry,False)
+            if checksum and oldEntry['crc']:
+                entry['crc'] = self.fileCRC(inPath)
+                if entry['crc']==oldEntry['crc']:
+                    return (entry,False)
+        if not entry['crc'] and fillCRC:
+            entry['crc'] = self.fileCRC(inPath)
+        return (entry,True)
 
     # Create XML-based manifest of files to backup with CRC32 checksums
-    def createManifest(self,compareManifestName=None):
+    # fileList holds (relative path, full path) pairs. Returns the manifest and the list of changed keys.
+    def createManifest(self,fileList,compareManifestName=None,checksum=False):
+        oldManifest = {}
         # If a manifest name was passed, use it for comparison
         if compareManifestName:
-            pass
-    def ftpSendFile(self,inFtpRef,inFileName):
-        success = False
+            oldManifest = self.loadManifest(compareManifestName)
+        manifest = {}
+        changed = []
+        for relPath,fullPath in fileList:
+            key = self.manifestKey(relPath)
+            try:
+                (entry,isChanged) = self.manifestEntry(fullPath,oldManifest.get(key),checksum)
+            except (IOError, os.error), why:
+                print "Can't read %s: %s" % (fullPath, str(why))
+                continue
+            manifest[key] = entry
+            if isChanged:
+                changed.append(key)
+        return (manifest,changed)
+
+    # Read a manifest written by saveManifest. A missing manifest is treated as empty.
+    # size and mtime come back as numbers, any other attribute (crc, hash) as a string.
+    # If info is passed it gets the attributes of the manifest element itself (src, date).
+    # manifestName may also be an open file.
+    def loadManifest(self,manifestName,info=None):
+        manifest = {}
+        if isinstance(manifestName,basestring) and not os.path.isfile(manifestName):
+            return manifest
+        try:
+            manifestDOM = xml.dom.minidom.parse(manifestName)
+        except Exception, why:
+            print "Can't read manifest %s: %s" % (manifestName, str(why))
+            return manifest
+        if info is not None:
+            rootNode = manifestDOM.documentElement
+            for attrName in rootNode.attributes.keys():
+                info[str(attrName)] = rootNode.getAttribute(attrName).encode('utf-8')
+        for fileNode in manifestDOM.getElementsByTagName("file"):
+            entry = {}
+            for attrName in fileNode.attributes.keys():
+                entry[str(attrName)] = fileNode.getAttribute(attrName).encode('utf-8')
+            entry['size'] = int(entry['size'])
+            entry['mtime'] = float(entry['mtime'])
+            entry.setdefault('crc','')
+            manifest[entry.pop('path')] = entry
+        manifestDOM.unlink()
+        return manifest
+
+    def saveManifest(self,manifest,manifestName,srcPath=''):
+        try:
+            f = open(manifestName,'w')
+            f.write("<?xml version='1.0' encoding='UTF-8' ?>\n")
+            f.write("<manifest src="+quoteattr(srcPath)+" date='"+strftime("%Y-%m-%d %H:%M")+"' files='"+str(len(manifest))+"' >\n")
+            keys = manifest.keys()
+            keys.sort()
+            for key in keys:
+                entry = manifest[key]
+                entryStr = "\t<file path="+quoteattr(key)+" size='"+str(entry['size'])+"' mtime='"+repr(entry['mtime'])+"'"
+                for field in entry.keys():
+                    if field not in ('size','mtime'):
+                        entryStr += " "+field+"="+quoteattr(str(entry[field]))
+                f.write(entryStr+" />\n")
+            f.write("</manifest>\n")
+            f.close()
+        except (IOError, os.error), why:
+            print "Can't write manifest %s: %s" % (manifestName, str(why))
+            return False
+        return True
+
+    # Remove destination files that are in the old manifest but were not seen in the source this run
+    def deleteOrphans(self,oldManifest,seenKeys,destPath):
+        i = 0
+        for key in oldManifest.keys():
+            if key not in seenKeys:
+                orphanPath = os.path.join(destPath,key.replace('/',os.sep))
+                if os.path.isfile(orphanPath):
+                    self.report("Deleting orphan:"+orphanPath)
+                    try:
+                        os.remove(orphanPath)
+                        i += 1
+                    except (IOError, os.error), why:
+                        print "Can't delete %s: %s" % (orphanPath,str(why))
+        return i
+
+    # Read the FTP transfer options of a task: blocksize for storbinary (default 64K), retries (default 3)
+    # with retrywait seconds before the first retry (default 2, doubling each time), and resume
+    def setFTPOptions(self,inAttr):
+        self.ftpBlockSize = self.sizeValue(inAttr.get('blocksize',self.props.get('ftp_blocksize','64K')),65536)
+        self.ftpRetries = self.attrInt(inAttr,'retries',3)
+        self.ftpRetryWait = self.attrInt(inAttr,'retrywait',2)
+        self.ftpResume = self.attrFlag(inAttr,'resume')
+
+    # Size of a remote file, or 0 if it doesn't exist or the server doesn't support SIZE
+    def ftpRemoteSize(self,ftph,remoteName):
+        try:
+            # SIZE is only reliable in binary mode
+            ftph.voidcmd("TYPE I")
+            remoteSize = ftph.size(remoteName)
+        except ftplib.error_perm:
+            return 0
+        return remoteSize or 0
+
+    # Store a file. With resume, what the server already has is kept and the rest is sent after REST.
+    def ftpStore(self,ftph,myFile,remoteName,resume=False):
+        offset = 0
+        if resume:
+            offset = self.ftpRemoteSize(ftph,remoteName)
+            fileSize = os.fstat(myFile.fileno()).st_size
+            if offset == fileSize:
+                return
+            if offset > fileSize:
+                offset = 0
+            if offset:
+                self.report("Resuming %s at %d bytes" % (remoteName,offset))
+        myFile.seek(offset)
+        ftph.storbinary("STOR " + remoteName,myFile,self.ftpBlockSize,lambda block: self.throttleBytes(len(block)),offset or None)
+
+    # Upload a file on a connection borrowed from an ftpPool. Runs on an upload thread. When the transfer or
+    # connection fails (timeout, reset, 4xx reply) the connection is replaced and, after a growing wait, the
+    # upload continues from the size the server has. Permanent (5xx) errors are raised at once.
+    def ftpPoolSend(self,pool,inFileName,remoteName):
         myFile = open(inFileName,'rb')
-        (fName,fExt) = os.path.splitext(inFileName)
+        ftph = None
         try:
-            inFtpRef.storbinary("STOR " + inFileName,myFile)
-            success = True
-        except Exception:
-            print "Upload failed!"
-        myFile.close()
-        return success
+            ftph = pool.get()
+            self.throttleFiles()
+            attempt = 0
+            while True:
+                try:
+                    if ftph is None:
+                        ftph = pool.connect()
+                    self.ftpStore(ftph,myFile,remoteName,self.ftpResume or attempt>0)
+                    return True
+                except (EOFError, IOError, ftplib.error_temp, ftplib.error_reply), why:
+                    pool.drop(ftph)
+                    ftph = None
+                    attempt += 1
+                    if attempt > self.ftpRetries:
+                        raise
+                    wait = self.ftpRetryWait*(2**(attempt-1))
+                    self.report("Upload of %s failed (%s), retry %d of %d in %d s" % (remoteName,str(why),attempt,self.ftpRetries,wait))
+                    time.sleep(wait)
+        finally:
+            myFile.close()
+            pool.put(ftph)
+
+    # Upload (local path, remote name) pairs on threads connections that stay logged in for the whole list.
+    # onSuccess, if given, is called with the local path of each file once it has been sent.
+    def ftpSendFiles(self,fileList,ftpURL,username,password,remoteDir="bu",threads=4,onSuccess=None):
+        pool = ftpPool(lambda: self.ftpConnect(ftpURL,username,password,remoteDir,False),threads)
+        # Log in once up front, so a bad host or password fails the task instead of every file
+        ftph = None
+        try:
+            ftph = pool.get()
+        finally:
+            pool.put(ftph)
+        jobs = workerPool(threads)
+        i = 0
+        try:
+            for inFileName,remoteName in fileList:
+                self.report("Sending "+remoteName+"...")
+                jobs.submit(self.ftpPoolSend,(pool,inFileName,remoteName),inFileName)
+                i += self.ftpSendResults(jobs.results(),onSuccess)
+            i += self.ftpSendResults(jobs.close(),onSuccess)
+        finally:
+            pool.close()
+        return i
+
+    def ftpSendResults(self,results,onSuccess=None):
+        i = 0
+        for inFileName,ok,value in results:
+            if ok:
+                i += 1
+                if onSuccess:
+                    onSuccess(inFileName)
+            else:
+                print "Upload of %s failed: %s" % (inFileName,str(value))
+        return i
 
-    def ftpConnect(self,inURL,inUsername,inPassword):
+    def ftpConnect(self,inURL,inUsername,inPassword,remoteDir="bu",verbose=True):
         #   "anonymous" "Anonymous" "anonymous" "Anonymous":
-        ftph = ftplib.FTP(inURL)
+        # host or host:port
+        (host,sep,port) = inURL.partition(':')
+        ftph = ftplib.FTP()
+        ftph.connect(host,int(port or 21))
         ftph.login(inUsername,inPassword)
-        print ftph.getwelcome()
-        ftph.cwd("bu")
-        curFtpPath = ftph.pwd()
-        print "Current path:"+curFtpPath
+        if verbose:
+            print ftph.getwelcome()
+        if remoteDir:
+            ftph.cwd(remoteDir)
+        if verbose:
+            curFtpPath = ftph.pwd()
+            print "Current path:"+curFtpPath
         return ftph
         # ftph.mkd(mkdirname)
         #upload(ftph,lf)
@@ -228,45 +1537,310 @@ class todocopy:
         #allfiles = ftph.nlst()
         # print ftph.dir()
 
-    # Get the manifest on the remote directory
-    def ftpGetManifest(self):
-        pass
-    def ftpArchiveList(self,inList,ftpURL,username,password):
-        connectPtr = self.ftpConnect(ftpURL,username,password)
-        #for arc in inList:
-        (head, tail) = os.path.split(inList)
-        print "Sending "+tail+"...\n"
-        # TODO: The FTP chokes on full paths, so the tail is being used. This is a prob for the crontab though
-        self.ftpSendFile(connectPtr,tail)
-        print "Completed ftp."
-    def doExec(self,cmdStr,asArray=True,standardError=True):
+    # Opener for archive writers streaming to FTP: everything written to the returned pipe is
+    # uploaded as the file's base name on the connection taskZip opened
+    def ftpStreamOpen(self,name):
+        remoteName = os.path.basename(name)
+        ftph = self.ftpStream
+        self.report("Streaming "+remoteName+" to "+ftph.host)
+        return uploadPipe(lambda pipe: ftph.storbinary("STOR "+remoteName,pipe,self.ftpBlockSize),name)
+
+    # Get the manifest on the remote directory: the manifest an earlier sync left there, or failing that
+    # one rebuilt from MLSD listings. Rebuilt entries carry the server's modify time and are marked listed.
+    def ftpGetManifest(self,ftph):
+        data = cStringIO.StringIO()
+        try:
+            ftph.retrbinary("RETR "+self.manifestName,data.write)
+        except ftplib.error_perm:
+            return self.ftpListManifest(ftph)
+        data.seek(0)
+        return self.loadManifest(data)
+
+    # Build a manifest of the remote tree from MLSD listings. Servers without MLSD give an empty manifest.
+    def ftpListManifest(self,ftph,remotePath=''):
+        manifest = {}
+        lines = []
+        try:
+            ftph.retrlines("MLSD "+remotePath if remotePath else "MLSD",lines.append)
+        except ftplib.error_perm:
+            return manifest
+        for line in lines:
+            (factStr,sep,name) = line.partition(' ')
+            facts = {}
+            for fact in factStr.split(';'):
+                (factName,sep,value) = fact.partition('=')
+                facts[factName.lower()] = value
+            key = remotePath+'/'+name if remotePath else name
+            fileType = facts.get('type','').lower()
+            if fileType == 'dir':
+                manifest.update(self.ftpListManifest(ftph,key))
+            elif fileType == 'file' and key != self.manifestName:
+                try:
+                    mtime = calendar.timegm(time.strptime(facts.get('modify','')[:14],"%Y%m%d%H%M%S"))
+                    manifest[key] = {'size':int(facts.get('size',-1)),'mtime':float(mtime),'crc':'','listed':'1'}
+                except ValueError:
+                    manifest[key] = {'size':-1,'mtime':0.0,'crc':'','listed':'1'}
+        return manifest
+
+    # Create the remote directories a file key needs, remembering the ones already made this run
+    def ftpMakeDirs(self,ftph,key,madeDirs):
+        parts = key.split('/')[:-1]
+        for i in range(1,len(parts)+1):
+            remotePath = '/'.join(parts[:i])
+            if remotePath not in madeDirs:
+                try:
+                    ftph.mkd(remotePath)
+                except ftplib.error_perm:
+                    # Most likely it exists already
+                    pass
+                madeDirs[remotePath] = 1
+
+    # Mirror a directory to an FTP server, uploading only new and changed files. A manifest kept on the
+    # server (or rebuilt from MLSD) gives the size, mtime and CRC of what is there. deleteorphans='1'
+    # removes remote files no longer in the source; checksum='1' compares contents of touched files.
+    def taskFTPSync(self,inAttr):
+        if 'ftp' not in imports:
+            print "FTP sync needs the ftplib module."
+            return False
+        srcDir = inAttr.get('src','')
+        ftpURL = inAttr.get('dest','')
+        if not srcDir or not os.path.isdir(srcDir) or not ftpURL:
+            print "FTP sync needs a src directory and an ftp host as dest."
+            return False
+        username = inAttr.get('username',self.props.get('ftp_username',''))
+        password = inAttr.get('password',self.props.get('ftp_password',''))
+        remoteDir = inAttr.get('ftpdir','bu')
+        checksum = self.attrFlag(inAttr,'checksum')
+        deleteOrphans = self.attrFlag(inAttr,'deleteorphans')
+        self.setThrottle(inAttr)
+        self.setFTPOptions(inAttr)
+        try:
+            ftph = self.ftpConnect(ftpURL,username,password,remoteDir,False)
+            remoteManifest = self.ftpGetManifest(ftph)
+        except ftplib.all_errors, why:
+            print "Can't connect to ftp %s: %s" % (ftpURL,str(why))
+            return False
+        manifest = {}
+        changed = {}
+        seenKeys = {}
+        madeDirs = {}
+        sendList = []
+        try:
+            for curPath,dirs,files in os.walk(srcDir):
+                if self.ignoreSVN and '.svn' in dirs:
+                    dirs.remove('.svn')
+                relDir = self.relativePath(srcDir,curPath)
+                for inName in files:
+                    inPath = os.path.join(curPath,inName)
+                    key = self.manifestKey(os.path.join(relDir,inName))
+                    if key == self.manifestName:
+                        continue
+                    seenKeys[key] = 1
+                    oldEntry = remoteManifest.get(key)
+                    try:
+                        fileStat = os.stat(inPath)
+                        if oldEntry and oldEntry.get('listed'):
+                            # A listed file is current if it has the same size and was uploaded after the last change
+                            isChanged = not (oldEntry['size']==fileStat.st_size and oldEntry['mtime']>=fileStat.st_mtime)
+                            entry = {'size':fileStat.st_size,'mtime':fileStat.st_mtime,'crc':''}
+                        else:
+                            (entry,isChanged) = self.manifestEntry(inPath,oldEntry,checksum,fileStat,checksum)
+                    except (IOError, os.error), why:
+                        print "Can't read %s: %s" % (inPath,str(why))
+                        continue
+                    if not isChanged:
+                        manifest[key] = entry
+                        continue
+                    self.ftpMakeDirs(ftph,key,madeDirs)
+                    changed[inPath] = (key,entry)
+                    sendList.append((inPath,key))
+            print "\n"+str(len(sendList))+" of "+str(len(seenKeys))+" files changed"
+            # Only uploaded files go into the new manifest, so a failed one is sent again next run
+            i = self.ftpSendFiles(sendList,ftpURL,username,password,remoteDir,self.attrInt(inAttr,'threads',4),
+                lambda inPath: manifest.__setitem__(*changed[inPath]))
+            # The control connection sat idle during the uploads and the server may have dropped it, so
+            # log in again for the deletes and the manifest
+            try:
+                ftph.quit()
+            except ftplib.all_errors:
+                ftph.close()
+            ftph = self.ftpConnect(ftpURL,username,password,remoteDir,False)
+            deleted = 0
+            for key in remoteManifest.keys():
+                if key in seenKeys:
+                    continue
+                if deleteOrphans:
+                    self.report("Deleting remote orphan:"+key)
+                    try:
+                        ftph.delete(key)
+                        deleted += 1
+                    except ftplib.error_perm, why:
+                        print "Can't delete %s: %s" % (key,str(why))
+                else:
+                    manifest[key] = remoteManifest[key]
+            self.ftpPutManifest(ftph,manifest,srcDir)
+        except ftplib.all_errors, why:
+            print "FTP sync to %s failed: %s" % (ftpURL,str(why))
+            return False
+        finally:
+            try:
+                ftph.quit()
+            except ftplib.all_errors:
+                ftph.close()
+        print "Uploaded "+str(i)+" of "+str(len(sendList))+" changed files"
+        if deleted:
+            print "Deleted "+str(deleted)+" remote orphans"
+        return i == len(sendList)
+
+    # Write the manifest to a temporary file and store it on the server
+    def ftpPutManifest(self,ftph,manifest,srcPath):
+        (fd,tempName) = tempfile.mkstemp(".xml")
+        os.close(fd)
+        try:
+            if self.saveManifest(manifest,tempName,srcPath):
+                tempFile = open(tempName,'rb')
+                try:
+                    ftph.storbinary("STOR "+self.manifestName,tempFile,self.ftpBlockSize)
+                finally:
+                    tempFile.close()
+        finally:
+            os.remove(tempName)
+    # Upload archive files (a path or a list of paths) in parallel. They are stored under their base names.
+    def ftpArchiveList(self,inList,ftpURL,username,password,remoteDir="bu",threads=4):
+        if isinstance(inList,basestring):
+            inList = [inList]
+        fileList = [(inPath,os.path.basename(inPath)) for inPath in inList]
+        try:
+            i = self.ftpSendFiles(fileList,ftpURL,username,password,remoteDir,threads)
+        except ftplib.all_errors, why:
+            print "Can't connect to ftp %s: %s" % (ftpURL,str(why))
+            return False
+        print "Completed ftp of "+str(i)+" of "+str(len(fileList))+" files."
+        return i == len(fileList)
+    # Run a command and return its output, as a list of lines or as one string. A failed command's
+    # output starts with an error marker. Commands whose output is only printed should use execStream.
+    def doExec(self,cmdStr,asArray=True,standardError=True,timeout=None):
         cmdStr = self.replaceTags(cmdStr)
-        rows = []
-        outStr = ''
-        if standardError:
-            cmdStr +=  " 2>&1"
-        myProcess  = os.popen(cmdStr)
-        for row in myProcess.readlines():     # run find command
-            if asArray:
-                rows.append(row)
-            else:
-                outStr += row
-        exitStatus = myProcess.close()
-        # Check if error occurred
-        if exitStatus:
+        # Without standardError, stderr goes to the screen rather than into the output
+        result = self.runCommand(cmdStr,lambda line: None,timeout,not standardError,sys.stderr.write,True)
+        rows = result.lines
+        outStr = ''.join(rows)
+        if not result.ok():
             outStr = "Error:"+outStr
-            rows.insert(0,"\n*** Error: ***\n")
-        else:
-            pass
+            rows.insert(0,"\n*** Error: "+str(result)+" ***\n")
         if asArray:
             return rows
-        else:
-            return outStr
+        return outStr
+
+    # Run a command with its output streamed to the screen and report a failure
+    def execStream(self,cmdStr,timeout=None):
+        result = self.runCommand(self.replaceTags(cmdStr),None,timeout)
+        if not result.ok():
+            print "\n*** Error: "+str(result)+" ***\n"
+        return result
+
+    def execOutput(self,line):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    # Run a command (a string for the shell, or an argument list) and hand each line of its output to
+    # output(line) as it arrives (default: print it), so memory stays flat however much it prints.
+    # stderr is merged into stdout, or with separate set goes to errorOutput. capture also keeps the
+    # stdout lines in the result. A command still running after timeout seconds or once cancelEvent is
+    # set is terminated along with its process group. Returns an execResult.
+    def runCommand(self,cmd,output=None,timeout=None,separate=False,errorOutput=None,capture=False):
+        result = execResult(cmd)
+        if output is None:
+            output = self.execOutput
+        if errorOutput is None:
+            errorOutput = output
+        stderrPipe = subprocess.STDOUT
+        if separate:
+            stderrPipe = subprocess.PIPE
+        startSession = None
+        if os.name == 'posix':
+            # Own process group, so a timeout also stops the rest of a shell pipeline
+            startSession = os.setsid
+        try:
+            proc = subprocess.Popen(cmd,shell=isinstance(cmd,basestring),stdout=subprocess.PIPE,stderr=stderrPipe,preexec_fn=startSession)
+        except os.error, why:
+            errorOutput("Can't run %s: %s\n" % (str(cmd),str(why)))
+            result.exitCode = 127
+            return result
+        # The readers hand the lines back so they are written on the calling thread. The queue is
+        # bounded, so a command that prints faster than its output is written just waits.
+        lineQueue = Queue.Queue(1024)
+        def pump(pipe,write,keep):
+            for line in iter(pipe.readline,''):
+                if keep:
+                    result.lines.append(line)
+                lineQueue.put((write,line))
+            pipe.close()
+        readers = [threading.Thread(target=pump,args=(proc.stdout,output,capture))]
+        if separate:
+            readers.append(threading.Thread(target=pump,args=(proc.stderr,errorOutput,False)))
+        for reader in readers:
+            reader.setDaemon(True)
+            reader.start()
+        deadline = None
+        if timeout:
+            deadline = time.time()+timeout
+        try:
+            while [reader for reader in readers if reader.isAlive()] or not lineQueue.empty():
+                try:
+                    (write,line) = lineQueue.get(True,0.05)
+                    write(line)
+                except Queue.Empty:
+                    pass
+                if proc.poll() is not None:
+                    continue
+                if self.cancelEvent.isSet():
+                    result.cancelled = True
+                    self.stopProcess(proc)
+                elif deadline and time.time()>deadline:
+                    result.timedOut = True
+                    self.stopProcess(proc)
+        except KeyboardInterrupt:
+            self.stopProcess(proc)
+            raise
+        result.exitCode = proc.wait()
+        return result
+
+    # Terminate a command and its process group, killing it if it hasn't gone after a few seconds
+    def stopProcess(self,proc):
+        for sig in (signal.SIGTERM,getattr(signal,'SIGKILL',None)):
+            try:
+                if os.name == 'posix':
+                    os.killpg(proc.pid,sig)
+                elif sig == signal.SIGTERM:
+                    proc.terminate()
+                else:
+                    proc.kill()
+            except os.error:
+                return
+            for i in range(50):
+                if proc.poll() is not None:
+                    return
+                time.sleep(0.1)
+
     def attr(self,attrList,attrName,default=''):
         if attrList.has_key(attrName):
             return attrList[attrName]
         else:
             return default
+    # Read an on/off task attribute, falling back to a <property> of the same name
+    def attrFlag(self,attrList,attrName,default=0):
+        value = attrList.get(attrName,self.props.get(attrName,default))
+        try:
+            return int(value)!=0
+        except (TypeError, ValueError):
+            return len(str(value))>0
+    # Read a numeric task attribute, falling back to a <property> of the same name
+    def attrInt(self,attrList,attrName,default=0):
+        try:
+            return int(attrList.get(attrName,self.props.get(attrName,default)))
+        except (TypeError, ValueError):
+            return default
     def addExample(self,cmdName,example,desc):
         self.examples.append({'name':cmdName,'example':example,'desc':desc})
     def curOS(self):
@@ -278,15 +1852,43 @@ class todocopy:
             return 'linux'
         else:
             return 'linux'
-    def getFileList(self,listPath):
+    # Open a file list ('-' for stdin) and return a generator over its entries, or None if it can't be read.
+    # delimiter is 'newline', 'nul' or '' to detect NUL-delimited lists from the first block.
+    def getFileList(self,listPath,delimiter=''):
         try:
-            f=open(listPath, 'r')
-            fileList = f.read()
-            f.close()
+            if listPath == '-':
+                f = sys.stdin
+            else:
+                f=open(listPath, 'rb')
         except (IOError, os.error), why:
-            print "Can't read filelist(%s): %s" % (inArgs[0], str(why))
+            print "Can't read filelist(%s): %s" % (listPath, str(why))
             return None
-        return fileList.split("\n")
+        return self.readFileList(f,{'newline':"\n",'nul':"\0"}.get(delimiter,''))
+
+    # Yield list entries as they are read so memory stays flat however long the list is
+    def readFileList(self,f,delimiter='',blockSize=65536):
+        pending = ''
+        try:
+            block = f.read(blockSize)
+            if not delimiter:
+                if "\0" in block:
+                    delimiter = "\0"
+                else:
+                    delimiter = "\n"
+            while block:
+                entries = (pending+block).split(delimiter)
+                # The last piece may be cut off mid-name, so keep it for the next block
+                pending = entries.pop()
+                for entry in entries:
+                    if delimiter == "\n":
+                        entry = entry.rstrip("\r")
+                    yield entry
+                block = f.read(blockSize)
+            if pending:
+                yield pending.rstrip("\r")
+        finally:
+            if f is not sys.stdin:
+                f.close()
 
         def firstDay(self,inMonth,inYear):
                 tempDay=datetime.date(inYear,inMonth,1)
@@ -408,16 +2010,19 @@ class todocopy:
         dirList = []
         fileList = []
         i = 0
+        self.absPaths = {}
         if recurse:
             for curPath,dirs,files in os.walk(srcDir):
+                # Every entry in this directory shares the same relative directory
+                relDir = self.relativePath(srcDir,curPath)
                 for inName in files:
-                    fileList.append(self.relativePath(srcDir,os.path.join(curPath,inName)))
+                    fileList.append(os.path.join(relDir,inName))
                     i += 1
                 if self.ignoreSVN:
                     if '.svn' in dirs:
                         dirs.remove('.svn')  # ignore the SVN metadata directories
                 for inName in dirs:
-                    tempDirPath = self.relativePath(srcDir,os.path.join(curPath,inName))
+                    tempDirPath = os.path.join(relDir,inName)
                     tempDirPath += os.sep
                     dirList.append(tempDirPath)
 
@@ -437,10 +2042,14 @@ class todocopy:
                 print "Setting property:"+destDir[1:-1]
             else:
                 outputType = inArgs.get('type','newline')
-                if outputType == 'newline':
-                    f = open(destDir,'w')
-                    f.write("\n".join(dirList))
-                    f.write("\n".join(fileList))
+                if outputType == 'newline' or outputType == 'nul':
+                    # NUL-delimited lists are safe for file names that contain newlines
+                    delimiter = {'newline':"\n",'nul':"\0"}[outputType]
+                    f = open(destDir,'wb')
+                    for entry in dirList:
+                        f.write(entry+delimiter)
+                    for entry in fileList:
+                        f.write(entry+delimiter)
                     f.close()
                 elif outputType =='comma':
                     import csv
@@ -452,67 +2061,935 @@ class todocopy:
             print "\n".join(dirList)
             print "\n".join(fileList)
 
+    # Copy a file only if it is new or changed since the destination manifest was written.
+    # The new entry is recorded in manifest and the key in seenKeys. Returns 'copied', 'unchanged' or 'failed'.
+    def copyChangedFile(self,inPath,destPath,oldManifest,manifest,seenKeys,checksum=False,relPath=None):
+        if relPath is None:
+            relPath = self.relativePath(self.basePath,inPath)
+        key = self.manifestKey(relPath)
+        seenKeys[key] = 1
+        try:
+            (entry,isChanged) = self.manifestEntry(inPath,oldManifest.get(key),checksum)
+        except (IOError, os.error), why:
+            print "Can't read %s: %s" % (inPath, str(why))
+            self.copyErrors += 1
+            return 'failed'
+        dest = os.path.join(destPath,relPath)
+        # A file deleted from the destination since the last run is copied again
+        if not isChanged and os.path.isfile(dest):
+            manifest[key] = entry
+            return 'unchanged'
+        # Only record the entry once the copy has succeeded, so a failed file is retried next run
+        if self.copyFile(inPath,destPath,lambda: manifest.__setitem__(key,entry),dest):
+            return 'copied'
+        return 'failed'
+
+    # Write the destination manifest and optionally remove orphans at the end of an incremental copy
+    def finishIncremental(self,oldManifest,manifest,seenKeys,srcPath,destPath,deleteOrphans):
+        if deleteOrphans:
+            deleted = self.deleteOrphans(oldManifest,seenKeys,destPath)
+            if deleted:
+                print "\nDeleted "+str(deleted)+" orphan files"
+        # Remember files no longer in the source so a later run with deleteorphans can still remove them
+        if not deleteOrphans:
+            for key in oldManifest.keys():
+                if key not in manifest and key not in seenKeys:
+                    manifest[key] = oldManifest[key]
+        self.saveManifest(manifest,os.path.join(destPath,self.manifestName),srcPath)
+
+    # Unpack a tar stream from the read end of a pipe into destDir. Runs on its own thread.
+    def tarUnpack(self,readFd,destDir,errors):
+        streamIn = os.fdopen(readFd,'rb')
+        try:
+            try:
+                tarIn = tarfile.open(fileobj=streamIn,mode='r|',bufsize=1048576)
+                tarIn.extractall(destDir)
+                tarIn.close()
+            except (tarfile.TarError, IOError, os.error), why:
+                errors.append(why)
+        finally:
+            streamIn.close()
+
+    # Copy a whole tree as one tar stream. The source is walked and written into a pipe while the other
+    # end unpacks it, so small files flow back to back instead of one open/copy/close round trip at a time.
+    # With tarcmd the stream goes to that command's stdin instead (e.g. tarcmd='ssh web2 tar -xf - -C /var/www').
+    def tarCopy(self,srcDir,destDir,inArgs):
+        tarCmd = self.replaceTags(inArgs.get('tarcmd',self.props.get('tarcmd','')))
+        errors = []
+        proc = None
+        reader = None
+        self.setThrottle(inArgs)
+        try:
+            if tarCmd:
+                proc = subprocess.Popen(tarCmd,shell=True,stdin=subprocess.PIPE)
+                streamOut = proc.stdin
+            else:
+                self.makeDestDir(destDir)
+                (readFd,writeFd) = os.pipe()
+                streamOut = os.fdopen(writeFd,'wb')
+                reader = threading.Thread(target=self.tarUnpack,args=(readFd,destDir,errors))
+                reader.setDaemon(True)
+                reader.start()
+        except (IOError, os.error), why:
+            print "Can't start tar copy to %s: %s" % (tarCmd or destDir,str(why))
+            return False
+        i = 0
+        failed = 0
+        tarOut = None
+        try:
+            try:
+                tarStream = streamOut
+                if self.byteLimiter:
+                    # maxbytespersec paces the tar stream itself
+                    tarStream = throttledFile(streamOut,self.throttleBytes)
+                tarOut = tarfile.open(fileobj=tarStream,mode='w|',bufsize=1048576)
+                for curPath,dirs,files in os.walk(srcDir):
+                    if self.ignoreSVN:
+                        if '.svn' in dirs:
+                            dirs.remove('.svn')  # ignore the SVN metadata directories
+                    relDir = self.relativePath(srcDir,curPath)
+                    for inName in dirs:
+                        tarOut.add(os.path.join(curPath,inName),os.path.join(relDir,inName),False)
+                    for inName in files:
+                        inPath = os.path.join(curPath,inName)
+                        self.report("Streaming file:"+inPath)
+                        self.throttleFiles()
+                        try:
+                            tarOut.add(inPath,os.path.join(relDir,inName),False)
+                            i += 1
+                        except (IOError, os.error), why:
+                            # The unpacking end has gone away, so there is no point going on
+                            if getattr(why,'errno',None)==errno.EPIPE:
+                                raise
+                            print "Can't stream %s: %s" % (inPath,str(why))
+                            failed += 1
+                tarOut.close()
+            except (IOError, os.error, tarfile.TarError), why:
+                errors.append(why)
+                if tarOut:
+                    # Drop the tar stream without flushing it into the broken pipe again
+                    tarOut.fileobj.closed = True
+        finally:
+            streamOut.close()
+            if reader:
+                reader.join()
+            if proc:
+                exitCode = proc.wait()
+                if exitCode:
+                    errors.append("tar command exited with status "+str(exitCode))
+        for why in errors:
+            print "Tar copy error: "+str(why)
+        print "\nStreamed "+str(i)+" files to "+(tarCmd or destDir)
+        if failed:
+            print "Failed to read "+str(failed)+" files"
+        return not errors
+
     def taskCopy(self,inArgs):
         #def copyFiles(self,srcDir,destDir,
         recurse=True
         inLog=False
         srcDir = inArgs['src']
         destDir = inArgs['dest']
+        # Tar mode streams the whole tree in one pass, so the per-file options below don't apply
+        if inArgs.get('mode',self.props.get('copymode','')) == 'tar':
+            self.basePath = srcDir
+            return self.tarCopy(srcDir,destDir,inArgs)
+        incremental = self.attrFlag(inArgs,'incremental')
+        checksum = self.attrFlag(inArgs,'checksum')
+        deleteOrphans = self.attrFlag(inArgs,'deleteorphans')
         #print srcDir, destDir
         self.returnStr = ""
         self.ignoreSVN = True
         self.basePath = srcDir
         i = 0
+        unchanged = 0
+        if incremental:
+            oldManifest = self.loadManifest(os.path.join(destDir,self.manifestName))
+            manifest = {}
+            seenKeys = {}
+        self.beginCopyTask(inArgs)
+        self.openJournal(inArgs)
         #walkLog=open(walkDir+'codescan_log.txt', 'w')
         if recurse:
             for curPath,dirs,files in os.walk(srcDir):
+                # Resolve this directory's destination once for all of its files
+                relDir = self.relativePath(srcDir,curPath)
+                outDir = os.path.join(destDir,relDir)
+                if files and not incremental:
+                    try:
+                        self.makeDestDir(outDir)
+                    except (IOError, os.error), why:
+                        # Each file will report the error when its copy fails
+                        pass
                 for inName in files:
                     #if inName[-3:] == "php":
                     #	processFile(inName,curPath,walkLog)
                     #print "Copy file:"+curPath+"/"+inName+" to "+destDir+curPath+"/"+inName
-                    self.copyFile(os.path.join(curPath,inName),destDir)
+                    if incremental:
+                        # Never copy a manifest from a tree that was itself a copy destination
+                        if inName == self.manifestName:
+                            continue
+                        result = self.copyChangedFile(os.path.join(curPath,inName),destDir,oldManifest,manifest,seenKeys,checksum,os.path.join(relDir,inName))
+                        if result == 'unchanged':
+                            unchanged += 1
+                            continue
+                    else:
+                        self.copyFile(os.path.join(curPath,inName),destDir,None,os.path.join(outDir,inName))
                     i += 1
                 if self.ignoreSVN:
                     if '.svn' in dirs:
                         dirs.remove('.svn')  # ignore the SVN metadata directories
             #walkLog.close()
-        if i>1:
-            print "\nCopied "+str(i)+" files"
+        self.endCopyTask()
+        if incremental:
+            self.finishIncremental(oldManifest,manifest,seenKeys,srcDir,destDir,deleteOrphans)
+            print "\nCopied "+str(i-self.copyErrors-self.journalSkipped)+" files, "+str(unchanged)+" unchanged"
+        elif i>1:
+            print "\nCopied "+str(i-self.copyErrors-self.journalSkipped)+" files"
+        if self.copyErrors:
+            print "Failed to copy "+str(self.copyErrors)+" files"
         return True
 
     def taskCopyList(self,inArgs):
-        fileList = self.getFileList(inArgs['filelist'])
+        fileList = self.getFileList(inArgs['filelist'],inArgs.get('delimiter',self.props.get('delimiter','')))
+        incremental = self.attrFlag(inArgs,'incremental')
+        checksum = self.attrFlag(inArgs,'checksum')
+        deleteOrphans = self.attrFlag(inArgs,'deleteorphans')
         if fileList:
             i = 0
+            unchanged = 0
+            if incremental:
+                oldManifest = self.loadManifest(os.path.join(inArgs['dest'],self.manifestName))
+                manifest = {}
+                seenKeys = {}
+            self.beginCopyTask(inArgs)
+            self.openJournal(inArgs)
             for curFile in fileList:
                 if(len(curFile)>0):
-                    if self.copyFile(curFile, inArgs['dest']):
-                        i += 1
-            self.report("Copied "+str(i)+" files.")
+                    if incremental:
+                        result = self.copyChangedFile(curFile,inArgs['dest'],oldManifest,manifest,seenKeys,checksum)
+                        if result == 'unchanged':
+                            unchanged += 1
+                            continue
+                    else:
+                        self.copyFile(curFile, inArgs['dest'])
+                    i += 1
+            self.endCopyTask()
+            # Queued copies count as attempted until the pool reports them, so subtract the failures and
+            # the files a resumed run skipped at the end
+            i -= self.copyErrors+self.journalSkipped
+            if incremental:
+                self.finishIncremental(oldManifest,manifest,seenKeys,inArgs['filelist'],inArgs['dest'],deleteOrphans)
+                self.report("Copied "+str(i)+" files, "+str(unchanged)+" unchanged.")
+            else:
+                self.report("Copied "+str(i)+" files.")
+
+    # SHA1 of the file contents, read in blocks
+    def fileHash(self,inPath,blockSize=1048576):
+        hasher = hashlib.sha1()
+        f = open(inPath,'rb')
+        try:
+            block = f.read(blockSize)
+            while block:
+                hasher.update(block)
+                block = f.read(blockSize)
+        finally:
+            f.close()
+        return hasher.hexdigest()
+
+    # Objects in a snapshot store are kept under their hash, fanned out by the first two characters
+    def snapshotObjectPath(self,storePath,fileHash):
+        return os.path.join(storePath,'objects',fileHash[:2],fileHash[2:])
+
+    # Add one file to a snapshot store and return (entry, stored). A file with the same size and mtime
+    # as in the previous snapshot reuses its hash, and content that is already stored isn't written again.
+    def snapshotFile(self,inPath,storePath,oldEntry=None):
+        fileStat = os.stat(inPath)
+        entry = {'size':fileStat.st_size,'mtime':fileStat.st_mtime,'hash':''}
+        if oldEntry and oldEntry.get('hash') and oldEntry['size']==entry['size'] and oldEntry['mtime']==entry['mtime']:
+            entry['hash'] = oldEntry['hash']
+        else:
+            entry['hash'] = self.fileHash(inPath)
+        objectPath = self.snapshotObjectPath(storePath,entry['hash'])
+        if os.path.isfile(objectPath):
+            return (entry,False)
+        self.makeDestDir(os.path.dirname(objectPath))
+        # Write under a temporary name so an interrupted run never leaves a partial object behind
+        tempPath = objectPath+".tmp_"+threading.currentThread().getName()
+        self.copyFileData(inPath,tempPath)
+        try:
+            os.rename(tempPath,objectPath)
+        except os.error:
+            # Windows won't rename over a file another thread stored first
+            if not os.path.isfile(objectPath):
+                raise
+            os.remove(tempPath)
+        return (entry,True)
+
+    # Content-addressed snapshots: action='create' (default) stores src in the store at dest,
+    # action='restore' restores the snapshot from the store at src into dest, action='list' lists them.
+    def taskSnapshot(self,inAttr):
+        action = inAttr.get('action','create')
+        if action=='restore':
+            return self.taskSnapshotRestore(inAttr)
+        elif action=='list':
+            return self.taskSnapshotList(inAttr)
+        if 'hashlib' not in imports:
+            print "Snapshots require the hashlib library (Python 2.5 or above)."
+            return False
+        srcDir = inAttr.get('src','')
+        storePath = inAttr.get('dest','')
+        snapName = self.replaceTags(inAttr.get('name','') or "{DATE}_{TIME}")
+        if not srcDir or not storePath:
+            print "Snapshot needs a src and a dest store."
+            return False
+        oldName = self.snapshotLatest(storePath)
+        oldIndex = {}
+        if oldName:
+            oldIndex = self.loadManifest(os.path.join(storePath,'snapshots',oldName+".xml"))
+        index = {}
+        totals = {'stored':0,'bytes':0}
+        self.basePath = srcDir
+        self.beginCopyTask(inAttr)
+        # Snapshots use the copy pool for threads, but handle the results themselves
+        pool = self.copyPool
+        self.copyPool = None
+        for curPath,dirs,files in os.walk(srcDir):
+            relDir = self.relativePath(srcDir,curPath)
+            for inName in files:
+                key = self.manifestKey(os.path.join(relDir,inName))
+                inPath = os.path.join(curPath,inName)
+                self.report("Snapshot file:"+inPath)
+                if pool:
+                    pool.submit(self.snapshotFile,(inPath,storePath,oldIndex.get(key)),(key,inPath))
+                    results = pool.results()
+                else:
+                    try:
+                        results = [((key,inPath),True,self.snapshotFile(inPath,storePath,oldIndex.get(key)))]
+                    except (IOError, os.error), why:
+                        results = [((key,inPath),False,why)]
+                self.snapshotResults(results,index,totals)
+            if self.ignoreSVN:
+                if '.svn' in dirs:
+                    dirs.remove('.svn')  # ignore the SVN metadata directories
+        if pool:
+            self.snapshotResults(pool.close(),index,totals)
+        self.makeDestDir(os.path.join(storePath,'snapshots'))
+        if self.saveManifest(index,os.path.join(storePath,'snapshots',snapName+".xml"),srcDir):
+            try:
+                f = open(os.path.join(storePath,'latest'),'w')
+                f.write(snapName)
+                f.close()
+            except (IOError, os.error), why:
+                print "Can't write %s: %s" % (os.path.join(storePath,'latest'),str(why))
+        print "\nSnapshot "+snapName+": "+str(len(index))+" files, "+str(totals['stored'])+" new objects ("+str(totals['bytes'])+" bytes stored)"
+        if self.copyErrors:
+            print "Failed to store "+str(self.copyErrors)+" files"
+        return True
+
+    # Record finished snapshotFile results in the index, in the order the files were walked
+    def snapshotResults(self,results,index,totals):
+        for (key,inPath),ok,value in results:
+            if ok:
+                index[key] = value[0]
+                if value[1]:
+                    totals['stored'] += 1
+                    totals['bytes'] += value[0]['size']
+            else:
+                print "Can't store %s: %s" % (inPath, str(value))
+                self.copyErrors += 1
+
+    # Name of the most recent snapshot in a store, or '' if there is none
+    def snapshotLatest(self,storePath):
+        try:
+            f = open(os.path.join(storePath,'latest'),'r')
+            snapName = f.read().strip()
+            f.close()
+            return snapName
+        except (IOError, os.error):
+            return ''
+
+    def taskSnapshotList(self,inAttr):
+        storePath = inAttr.get('src','') or inAttr.get('dest','')
+        try:
+            names = os.listdir(os.path.join(storePath,'snapshots'))
+        except (IOError, os.error), why:
+            print "Can't list snapshots in %s: %s" % (storePath,str(why))
+            return False
+        names.sort()
+        for snapName in names:
+            if snapName[-4:]==".xml":
+                print snapName[:-4]
+        return True
+
+    # Restore a snapshot from the store at src into dest. With link='1' files are hardlinked
+    # to the stored objects instead of copied, which is instant but shares the data with the store.
+    def taskSnapshotRestore(self,inAttr):
+        storePath = inAttr.get('src','')
+        destDir = inAttr.get('dest','')
+        snapName = self.replaceTags(inAttr.get('name','')) or self.snapshotLatest(storePath)
+        useLinks = self.attrFlag(inAttr,'link') and hasattr(os,'link')
+        indexName = os.path.join(storePath,'snapshots',snapName+".xml")
+        if not snapName or not os.path.isfile(indexName):
+            print "Can't find snapshot '%s' in %s" % (snapName,storePath)
+            return False
+        index = self.loadManifest(indexName)
+        # Restore copies on this thread, so it needs only the per-task state, not a copy pool
+        self.copyErrors = 0
+        self.madeDirs = {}
+        self.setThrottle(inAttr)
+        i = 0
+        for key in index.keys():
+            entry = index[key]
+            objectPath = self.snapshotObjectPath(storePath,entry['hash'])
+            dest = os.path.join(destDir,key.replace('/',os.sep))
+            self.report("Restoring file:"+dest)
+            try:
+                self.makeDestDir(os.path.dirname(dest))
+                if os.path.exists(dest):
+                    os.remove(dest)
+                if useLinks:
+                    os.link(objectPath,dest)
+                else:
+                    self.copyFileData(objectPath,dest)
+                    os.utime(dest,(entry['mtime'],entry['mtime']))
+                i += 1
+            except (IOError, os.error), why:
+                print "Can't restore %s: %s" % (dest,str(why))
+        print "\nRestored "+str(i)+" of "+str(len(index))+" files from snapshot "+snapName
+        return True
+
+    # Archives to verify, extract or upload: src is a comma separated list of archive files, of directories
+    # (the archives in them) or of archive base names, which stand for all their volumes (name_0.zip,
+    # name_1.zip, ...) or tar files. Without src, the archives written earlier in this run.
+    def findArchives(self,src):
+        if not src:
+            return list(self.archiveList)
+        archiveExts = ['.zip']+['.'+archiveFormat for archiveFormat in tarWriter.levels.keys()]
+        archives = []
+        for name in src.split(','):
+            name = name.strip()
+            if os.path.isfile(name):
+                archives.append(name)
+                continue
+            if os.path.isdir(name):
+                found = [os.path.join(name,inName) for inName in sorted(os.listdir(name))
+                    if [ext for ext in archiveExts if inName.endswith(ext)] and os.path.isfile(os.path.join(name,inName))]
+                if not found:
+                    print "No archive found in "+name
+                archives.extend(found)
+                continue
+            found = len(archives)
+            i = 0
+            while os.path.isfile(name+"_"+str(i)+".zip"):
+                archives.append(name+"_"+str(i)+".zip")
+                i += 1
+            for archiveFormat in tarWriter.levels.keys():
+                if os.path.isfile(name+"."+archiveFormat):
+                    archives.append(name+"."+archiveFormat)
+            if len(archives) == found:
+                print "No archive found for "+name
+        return archives
+
+    # Open a tar archive written by tarWriter for reading as a stream
+    def openTarStream(self,inPath,bufSize=4194304):
+        if inPath.endswith('.tar.xz'):
+            if 'lzma' not in imports:
+                raise IOError("reading tar.xz needs the lzma module")
+            fileObj = lzma.LZMAFile(inPath,'rb')
+        elif inPath.endswith('.tar.zst'):
+            if 'zstd' not in imports:
+                raise IOError("reading tar.zst needs the zstandard module")
+            fileObj = zstandard.ZstdDecompressor().stream_reader(open(inPath,'rb',bufSize))
+        elif inPath.endswith('.tar.gz') or inPath.endswith('.tgz'):
+            fileObj = gzip.GzipFile(fileobj=open(inPath,'rb',bufSize))
+        else:
+            fileObj = open(inPath,'rb',bufSize)
+        return (fileObj,tarfile.open(fileobj=fileObj,mode='r|',bufsize=bufSize))
+
+    # Read a zip member's data straight from its volume, given the ZipInfo from the central directory.
+    # Yields (compressed bytes read, uncompressed block) and raises IOError if the member is damaged.
+    def readZipMember(self,f,zinfo,blockSize):
+        if zinfo.flag_bits & 0x01:
+            raise IOError("encrypted member")
+        f.seek(zinfo.header_offset)
+        header = f.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader:
+            raise IOError("truncated local header")
+        fields = struct.unpack(zipfile.structFileHeader,header)
+        if fields[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise IOError("bad local header")
+        f.seek(fields[zipfile._FH_FILENAME_LENGTH]+fields[zipfile._FH_EXTRA_FIELD_LENGTH],1)
+        decompressor = None
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            decompressor = zlib.decompressobj(-15)
+        elif zinfo.compress_type != zipfile.ZIP_STORED:
+            raise IOError("unsupported compression type "+str(zinfo.compress_type))
+        crc = 0
+        fileSize = 0
+        remaining = zinfo.compress_size
+        while remaining>0:
+            block = f.read(min(blockSize,remaining))
+            if not block:
+                raise IOError("truncated member data")
+            remaining -= len(block)
+            rawSize = len(block)
+            try:
+                if decompressor:
+                    block = decompressor.decompress(block)
+            except zlib.error, why:
+                raise IOError("bad compressed data: "+str(why))
+            fileSize += len(block)
+            crc = zlib.crc32(block,crc)
+            yield (rawSize,block)
+        if decompressor:
+            block = decompressor.flush()
+            fileSize += len(block)
+            crc = zlib.crc32(block,crc)
+            yield (0,block)
+        if crc & 0xffffffff != zinfo.CRC:
+            raise IOError("CRC mismatch")
+        if fileSize != zinfo.file_size:
+            raise IOError("size mismatch")
+
+    # Check a batch of zip members by reading their data straight from the volume. Runs on a worker thread,
+    # so it uses its own file handle. Returns the (name, size, crc, error) of each member and the bytes read.
+    def verifyZipMembers(self,inPath,members,blockSize):
+        results = []
+        bytesRead = 0
+        f = open(inPath,'rb',blockSize)
+        try:
+            for zinfo in members:
+                error = None
+                crc = 0
+                fileSize = 0
+                try:
+                    for rawSize,block in self.readZipMember(f,zinfo,blockSize):
+                        bytesRead += rawSize
+                        fileSize += len(block)
+                        crc = zlib.crc32(block,crc)
+                except (IOError, os.error, struct.error), why:
+                    error = str(why)
+                results.append((zinfo.filename,fileSize,crc & 0xffffffff,error))
+        finally:
+            f.close()
+        return (results,bytesRead)
+
+    # Read every member of a tar archive. Tar has no checksums of its own, so the CRCs are only
+    # compared when there is a manifest. Runs on a worker thread.
+    def verifyTarFile(self,inPath,blockSize):
+        results = []
+        (fileObj,tarIn) = self.openTarStream(inPath,blockSize)
+        try:
+            for tinfo in tarIn:
+                if not tinfo.isfile():
+                    continue
+                data = tarIn.extractfile(tinfo)
+                crc = 0
+                fileSize = 0
+                block = data.read(blockSize)
+                while block:
+                    fileSize += len(block)
+                    crc = zlib.crc32(block,crc)
+                    block = data.read(blockSize)
+                error = None
+                if fileSize != tinfo.size:
+                    error = "truncated member data"
+                results.append((tinfo.name,fileSize,crc & 0xffffffff,error))
+                tarIn.members = []
+        finally:
+            tarIn.close()
+            fileObj.close()
+        return (results,os.path.getsize(inPath))
+
+    # Test every member of every archive volume in parallel and optionally compare them against an archive
+    # manifest (manifest='name_manifest.xml') or the source tree (source='dir'). Reports throughput.
+    def taskVerify(self,inAttr):
+        archives = self.findArchives(self.replaceTags(inAttr.get('src','')))
+        if not archives:
+            print "No archives to verify."
+            return False
+        blockSize = self.sizeValue(inAttr.get('blocksize',self.props.get('verifyblocksize','4M')),4194304)
+        # Members are checked in batches of about this many compressed bytes, so small files don't cost a job each
+        batchSize = 64*1048576
+        expected = {}
+        prefix = ''
+        manifestName = self.replaceTags(inAttr.get('manifest',''))
+        sourceDir = self.replaceTags(inAttr.get('source',''))
+        if manifestName:
+            info = {}
+            expected = self.loadManifest(manifestName,info)
+            if not expected:
+                print "No entries in manifest "+manifestName
+                return False
+            prefix = archiveName(info.get('src',''))+'/'
+            # Chain manifests (base.last.xml) also list files held by other archives
+            volumeNames = {}
+            for inPath in archives:
+                volumeNames[os.path.basename(inPath)] = 1
+            for key in expected.keys():
+                if 'archive' in expected[key] and expected[key]['archive'] not in volumeNames:
+                    del expected[key]
+        elif sourceDir:
+            prefix = archiveName(os.path.abspath(sourceDir))+'/'
+        pool = workerPool(self.attrInt(inAttr,'threads',4))
+        startTime = time.time()
+        for inPath in archives:
+            if inPath.endswith('.zip'):
+                try:
+                    zipIn = zipfile.ZipFile(inPath)
+                    members = zipIn.infolist()
+                    zipIn.close()
+                except (IOError, os.error, zipfile.BadZipfile), why:
+                    pool.submit(self.verifyZipMembers,(inPath,[],blockSize),(inPath,str(why)))
+                    continue
+                batch = []
+                batchBytes = 0
+                for zinfo in members:
+                    batch.append(zinfo)
+                    batchBytes += zinfo.compress_size
+                    if batchBytes >= batchSize:
+                        pool.submit(self.verifyZipMembers,(inPath,batch,blockSize),(inPath,None))
+                        batch = []
+                        batchBytes = 0
+                if batch:
+                    pool.submit(self.verifyZipMembers,(inPath,batch,blockSize),(inPath,None))
+            else:
+                pool.submit(self.verifyTarFile,(inPath,blockSize),(inPath,None))
+        totals = {'members':0,'bad':0,'bytes':0,'size':0,'differs':0}
+        seen = {}
+        for (inPath,openError),ok,value in pool.close():
+            if openError:
+                print "Can't read archive %s: %s" % (inPath,openError)
+                totals['bad'] += 1
+                continue
+            if not ok:
+                print "Can't read archive %s: %s" % (inPath,str(value))
+                totals['bad'] += 1
+                continue
+            (results,bytesRead) = value
+            totals['bytes'] += bytesRead
+            for name,fileSize,crc,error in results:
+                totals['members'] += 1
+                totals['size'] += fileSize
+                if error:
+                    print "Bad member %s in %s: %s" % (name,inPath,error)
+                    totals['bad'] += 1
+                    continue
+                if not prefix or not name.startswith(prefix):
+                    continue
+                key = name[len(prefix):]
+                seen[key] = 1
+                if manifestName:
+                    entry = expected.get(key)
+                    if entry and (entry['size'] != fileSize or (entry['crc'] and entry['crc'] != "%08x" % crc)):
+                        print "Differs from manifest: "+key
+                        totals['differs'] += 1
+                else:
+                    srcPath = os.path.join(sourceDir,key.replace('/',os.sep))
+                    try:
+                        if os.path.getsize(srcPath) != fileSize or self.fileCRC(srcPath,blockSize) != "%08x" % crc:
+                            print "Differs from source: "+key
+                            totals['differs'] += 1
+                    except (IOError, os.error):
+                        print "Not in source: "+key
+                        totals['differs'] += 1
+        missing = 0
+        if manifestName:
+            for key in expected.keys():
+                if key not in seen:
+                    print "Missing from archive: "+key
+                    missing += 1
+        elif sourceDir:
+            for curPath,dirs,files in os.walk(sourceDir):
+                relDir = self.relativePath(sourceDir,curPath)
+                for inName in files:
+                    if self.manifestKey(os.path.join(relDir,inName)) not in seen:
+                        print "Missing from archive: "+os.path.join(curPath,inName)
+                        missing += 1
+        elapsed = max(time.time()-startTime,0.001)
+        print "\nVerified %d members in %d archives: %d bad, %d differ, %d missing" % (totals['members'],len(archives),totals['bad'],totals['differs'],missing)
+        print "Read %.1f MB (%.1f MB uncompressed) in %.2f s, %.1f MB/s" % (totals['bytes']/1048576.0,totals['size']/1048576.0,elapsed,totals['size']/1048576.0/elapsed)
+        return not (totals['bad'] or totals['differs'] or missing)
+
+    # Where a member is extracted to: its name without the strip prefix, below destDir. Names that would
+    # land outside destDir are refused.
+    def extractPath(self,name,destDir,strip):
+        if strip:
+            if not name.startswith(strip+'/'):
+                return None
+            name = name[len(strip)+1:]
+        relPath = os.path.normpath(name.replace('/',os.sep))
+        if os.path.isabs(relPath) or relPath.startswith(os.pardir):
+            return None
+        return os.path.join(destDir,relPath)
+
+    # True if a member name matches one of the select globs, or lies below a selected directory
+    def extractSelected(self,name,patterns):
+        if not patterns:
+            return True
+        for pattern in patterns:
+            if fnmatch.fnmatchcase(name,pattern) or name.startswith(pattern+'/'):
+                return True
+        return False
+
+    # Write one batch of members from a zip volume. Runs on a worker thread with its own file handle.
+    # Returns the (name, error) of each member and the bytes read.
+    def extractZipMembers(self,inPath,members,blockSize):
+        results = []
+        bytesRead = 0
+        f = open(inPath,'rb',blockSize)
+        try:
+            for zinfo,outPath in members:
+                error = None
+                try:
+                    self.makeDestDir(os.path.dirname(outPath))
+                    outFile = open(outPath,'wb')
+                    try:
+                        for rawSize,block in self.readZipMember(f,zinfo,blockSize):
+                            bytesRead += rawSize
+                            outFile.write(block)
+                    finally:
+                        outFile.close()
+                    mode = (zinfo.external_attr >> 16) & 07777
+                    if mode:
+                        os.chmod(outPath,mode)
+                    mtime = time.mktime(zinfo.date_time+(0,0,-1))
+                    os.utime(outPath,(mtime,mtime))
+                except (IOError, os.error, struct.error, OverflowError, ValueError), why:
+                    error = str(why)
+                results.append((zinfo.filename,error))
+        finally:
+            f.close()
+        return (results,bytesRead)
+
+    # Extract the selected members of a tar archive. Tar can't be indexed, so the stream is read through once.
+    def extractTarFile(self,inPath,destDir,patterns,strip,blockSize):
+        results = []
+        (fileObj,tarIn) = self.openTarStream(inPath,blockSize)
+        try:
+            for tinfo in tarIn:
+                if not tinfo.isfile() or not self.extractSelected(tinfo.name,patterns):
+                    continue
+                outPath = self.extractPath(tinfo.name,destDir,strip)
+                if outPath is None:
+                    continue
+                error = None
+                try:
+                    self.makeDestDir(os.path.dirname(outPath))
+                    data = tarIn.extractfile(tinfo)
+                    outFile = open(outPath,'wb')
+                    try:
+                        block = data.read(blockSize)
+                        while block:
+                            outFile.write(block)
+                            block = data.read(blockSize)
+                    finally:
+                        outFile.close()
+                    os.chmod(outPath,tinfo.mode & 07777)
+                    os.utime(outPath,(tinfo.mtime,tinfo.mtime))
+                except (IOError, os.error), why:
+                    error = str(why)
+                results.append((tinfo.name,error))
+                tarIn.members = []
+        finally:
+            tarIn.close()
+            fileObj.close()
+        return (results,os.path.getsize(inPath))
 
+    # Restore files from an archive into dest. The central directories of all zip volumes are read first
+    # as the index, so only the members matching select (comma separated globs or directories, matched
+    # against member names) are read, in batches on a worker pool. strip removes a leading path from the
+    # member names, e.g. strip='var/www' with dest='/tmp/www'.
+    def taskExtract(self,inAttr):
+        archives = self.findArchives(self.replaceTags(inAttr.get('src','')))
+        destDir = self.replaceTags(inAttr.get('dest',''))
+        if not archives or not destDir:
+            print "Extract needs a src archive and a dest directory."
+            return False
+        patterns = []
+        for pattern in inAttr.get('select','').split(','):
+            pattern = pattern.strip().strip('/')
+            if pattern:
+                patterns.append(pattern)
+        strip = inAttr.get('strip','').strip('/')
+        blockSize = self.sizeValue(inAttr.get('blocksize',self.props.get('verifyblocksize','4M')),4194304)
+        batchSize = 64*1048576
+        pool = workerPool(self.attrInt(inAttr,'threads',4))
+        startTime = time.time()
+        indexed = 0
+        for inPath in archives:
+            if not inPath.endswith('.zip'):
+                pool.submit(self.extractTarFile,(inPath,destDir,patterns,strip,blockSize),inPath)
+                continue
+            try:
+                zipIn = zipfile.ZipFile(inPath)
+                members = zipIn.infolist()
+                zipIn.close()
+            except (IOError, os.error, zipfile.BadZipfile), why:
+                print "Can't read archive %s: %s" % (inPath,str(why))
+                continue
+            indexed += len(members)
+            batch = []
+            batchBytes = 0
+            for zinfo in members:
+                if zinfo.filename.endswith('/') or not self.extractSelected(zinfo.filename,patterns):
+                    continue
+                outPath = self.extractPath(zinfo.filename,destDir,strip)
+                if outPath is None:
+                    print "Not extracting %s: outside %s" % (zinfo.filename,destDir)
+                    continue
+                batch.append((zinfo,outPath))
+                batchBytes += zinfo.compress_size
+                if batchBytes >= batchSize:
+                    pool.submit(self.extractZipMembers,(inPath,batch,blockSize),inPath)
+                    batch = []
+                    batchBytes = 0
+            if batch:
+                pool.submit(self.extractZipMembers,(inPath,batch,blockSize),inPath)
+        i = 0
+        failed = 0
+        bytesRead = 0
+        for inPath,ok,value in pool.close():
+            if not ok:
+                print "Can't read archive %s: %s" % (inPath,str(value))
+                failed += 1
+                continue
+            (results,readSize) = value
+            bytesRead += readSize
+            for name,error in results:
+                if error:
+                    print "Can't extract %s from %s: %s" % (name,inPath,error)
+                    failed += 1
+                else:
+                    self.report("Extracted:"+name)
+                    i += 1
+        elapsed = max(time.time()-startTime,0.001)
+        print "\nExtracted %d files (%d failed) from %d archives to %s" % (i,failed,len(archives),destDir)
+        print "Read %.1f MB in %.2f s, %.1f MB/s" % (bytesRead/1048576.0,elapsed,bytesRead/1048576.0/elapsed)
+        return not failed
+
+    # Upload every file in a list to the FTP server in dest, on threads (default 4) parallel connections
     def taskFTPList(self,inArgs):
-        fileList = self.getFileList(inArgs['filelist'])
+        fileList = self.getFileList(inArgs['filelist'],inArgs.get('delimiter',self.props.get('delimiter','')))
+        self.setThrottle(inArgs)
+        self.setFTPOptions(inArgs)
+        ftpURL = inArgs.get('dest','')
+        if not ftpURL:
+            print "ftplist needs an ftp host as dest."
+            return False
         if fileList:
-            # TODO: Add FTP connection
-            i = 0
-            for curFile in fileList:
-                if(len(curFile)>0):
-                    (head, tail) = os.path.split(curFile)
-                    self.report("Sending "+tail+"...\n")
-                    # TODO: The FTP chokes on full paths, so the tail is being used. This is a prob for the crontab though
-                    if self.ftpSendFile(connectPtr,tail):
-                        i += 1
+            username = inArgs.get('username',self.props.get('ftp_username',''))
+            password = inArgs.get('password',self.props.get('ftp_password',''))
+            remoteDir = inArgs.get('ftpdir','bu')
+            base = inArgs.get('base','')
+            try:
+                ftph = self.ftpConnect(ftpURL,username,password,remoteDir,False)
+            except ftplib.all_errors, why:
+                print "Can't connect to ftp %s: %s" % (ftpURL,str(why))
+                return False
+            # Files keep their path (relative to base), so files with the same name in different
+            # directories don't overwrite each other. The remote directories are made before each upload starts.
+            madeDirs = {}
+            def sendList():
+                for curFile in fileList:
+                    if len(curFile)>0:
+                        relPath = self.relativePath(base,curFile) if base else curFile
+                        key = self.manifestKey(archiveName(relPath))
+                        self.ftpMakeDirs(ftph,key,madeDirs)
+                        yield (curFile,key)
+            try:
+                i = self.ftpSendFiles(sendList(),ftpURL,username,password,remoteDir,self.attrInt(inArgs,'threads',4))
+            except ftplib.all_errors, why:
+                print "FTP to %s failed: %s" % (ftpURL,str(why))
+                return False
+            finally:
+                try:
+                    ftph.quit()
+                except ftplib.all_errors:
+                    ftph.close()
             self.report("FTPed "+str(i)+" files.")
 
+    # Run the tasks inside a <parallel> block at the same time, at most maxworkers at once (default all), and
+    # wait for all of them. Each task works on its own copy of the properties and tags, so e.g. three
+    # <mysql action='dump'> tasks can each set their own database. Output lines get a [name] prefix (the
+    # task's name attribute, or its tag and position); output='group' prints each task's output in one
+    # piece when it finishes instead. Returns False if any task raised an error or failed its failonerror.
+    def taskParallel(self,block):
+        tasks = [node for node in block.childNodes if node.localName and node.getAttribute('enabled') != '0']
+        if not tasks:
+            return True
+        maxWorkers = int(self.getAttr(block,'maxworkers','0') or 0) or len(tasks)
+        hold = self.getAttr(block,'output','prefix') == 'group'
+        output = sys.stdout
+        installed = not isinstance(output,threadOutput)
+        if installed:
+            output = threadOutput(sys.stdout)
+            sys.stdout = output
+        # Nested blocks add their task names to the outer task's prefix
+        outerPrefix = output.prefix()
+        def runTask(node,label):
+            output.begin(outerPrefix+"["+label+"] ",hold)
+            ok = False
+            try:
+                worker = self.workerState()
+                group = block.ownerDocument.createElement('parallel')
+                group.appendChild(node.cloneNode(True))
+                ok = worker.executeScript(group,'parallel')
+                return ok
+            finally:
+                status = 'done'
+                if not ok:
+                    status = 'failed'
+                output.end("=== "+outerPrefix+label+" ("+status+") ===\n")
+        startTime = time.time()
+        jobs = workerPool(min(maxWorkers,len(tasks)),len(tasks))
+        try:
+            for i in range(len(tasks)):
+                label = tasks[i].getAttribute('name') or "%s%d" % (tasks[i].localName,i+1)
+                jobs.submit(runTask,(tasks[i],label),label)
+            results = jobs.close()
+        finally:
+            if installed:
+                sys.stdout = output.stream
+        failed = []
+        for label,ok,value in results:
+            if not ok:
+                print "*** Error: parallel task %s: %s ***" % (label,str(value))
+                failed.append(label)
+            elif not value:
+                failed.append(label)
+        print "Parallel block: %d tasks in %.1fs, %d failed" % (len(tasks),time.time()-startTime,len(failed))
+        return len(failed)==0
+
+    # Run the command in executable (or value). Its output streams to the screen, or to the file in output
+    # (append='1' adds to it). timeout is in seconds; separate='1' sends stderr to stderr instead of the output.
     def taskExec(self,inAttr):
         if inAttr:
-            cmdStr = ''
-            if inAttr.has_key('value'):
-                cmdStr = inAttr['value'].value
-            if inAttr.has_key('executable'):
-                cmdStr = inAttr['executable'].value
-            returnArray = self.doExec(cmdStr)
-            print ''.join(returnArray)
+            cmdStr = inAttr.get('executable',inAttr.get('value',''))
+            timeout = self.attrInt(inAttr,'timeout',0) or None
+            separate = self.attrFlag(inAttr,'separate')
+            errorOutput = None
+            if separate:
+                errorOutput = sys.stderr.write
+            outFile = None
+            output = None
+            if inAttr.get('output',''):
+                outName = self.replaceTags(inAttr['output'])
+                try:
+                    outFile = open(outName,'a' if self.attrFlag(inAttr,'append') else 'w')
+                except (IOError, os.error), why:
+                    print "Can't write %s: %s" % (outName,str(why))
+                    return False
+                output = outFile.write
+            try:
+                result = self.runCommand(self.replaceTags(cmdStr),output,timeout,separate,errorOutput)
+            finally:
+                if outFile:
+                    outFile.close()
+            if not result.ok():
+                print "\n*** Error: "+cmdStr+": "+str(result)+" ***\n"
+            return result.ok()
 
     def taskSVNDirList(self,inAttr):
         if self.cmdOptions.recursive:
@@ -588,8 +3065,7 @@ class todocopy:
         # This is perfect for a moving files from a dev checkout to a production checkout
         elif action=='sync':
             cmdStr = "svn revert . -R"
-            returnArray = self.doExec(cmdStr)
-            print ''.join(returnArray)
+            self.execStream(cmdStr)
             cmdStr = "svn status --xml"
             returnArray = self.doExec(cmdStr)
             #print ''.join(returnArray)
@@ -611,8 +3087,7 @@ class todocopy:
                         else:
                             os.remove(delPath)
             cmdStr = "svn up"
-            returnArray = self.doExec(cmdStr)
-            print ''.join(returnArray)
+            self.execStream(cmdStr)
         elif action=='property':
             filePath = inAttr.get('path', '')
             propName = inAttr.get('name', '')
@@ -647,8 +3122,7 @@ class todocopy:
             if filePath:
                 cmdStr = "svn add "+filePath
                 print cmdStr
-                returnArray = self.doExec(cmdStr)
-                print ''.join(returnArray)
+                self.execStream(cmdStr)
 
         elif action=='log':
             recurse = inAttr.get('recurse', 0)
@@ -1009,46 +3483,389 @@ class todocopy:
             if(toScreen):
                 print logStr
 
-    def taskFTP(self,fileList,ftpURL,username,password):
+    # Upload an archive (a file or the base name of its volumes), or the archives written earlier in the run
+    def taskFTP(self,fileList,ftpURL,username,password,inAttr=None):
+        if inAttr is None:
+            inAttr = {}
+        if self.attrFlag(inAttr,'sync'):
+            return self.taskFTPSync(inAttr)
         print "\nStarting ftp to "+ftpURL+"..."
-        passList = (fileList)
-        self.ftpArchiveList(passList,ftpURL,username,password)
-    def taskZip(self,inSrc,inDest,inFile,recurse=True,inLog=False):
+        self.setFTPOptions(inAttr)
+        passList = self.findArchives(fileList)
+        self.ftpArchiveList(passList,ftpURL,username,password,inAttr.get('ftpdir','bu'),self.attrInt(inAttr,'threads',4))
+    # Zip inSrc into inDest/inFile_0.zip, inFile_1.zip, ... Volumes are split so none is larger than
+    # the volumesize attribute or property (K/M/G suffixes allowed, 0 for no split, default 600 MB).
+    # format='tar.gz', 'tar.xz' or 'tar.zst' writes a single compressed tar stream instead, and
+    # level sets the compression level (zip and tar.gz 0-9, tar.xz 0-9, tar.zst 1-22).
+    # mode='full', 'incremental' or 'differential' archives only what changed; see beginArchiveManifest.
+    # ftp='host' (with username, password and ftpdir, default bu) streams the archive to the FTP server
+    # while it is being written, so no local copy is made.
+    def taskZip(self,inSrc,inDest,inFile,recurse=True,inLog=False,inAttr=None):
+        if inAttr is None:
+            inAttr = {}
         if self.props['noarchive']:
             print "No archiving, just transfer file."
             self.archiveList.append(self.props['noarchive'])
         else:
+            archiveFormat = inAttr.get('format',self.props.get('archiveformat','zip'))
+            archiveMode = inAttr.get('mode',self.props.get('archivemode',''))
+            if archiveMode and inFile and not self.testMode:
+                if not self.beginArchiveManifest(inSrc,inDest,archiveMode,inAttr):
+                    return False
+            self.storeExt = [ext.strip().lstrip('.').lower() for ext in str(inAttr.get('storeext',self.props.get('storeext',''))).split(',') if ext.strip()]
+            self.storeGain = self.attrInt(inAttr,'storegain',5)
+            self.storeTest = self.attrFlag(inAttr,'storetest',1)
+            opener = None
+            ftpHost = inAttr.get('ftp','')
+            if ftpHost and inFile and not self.testMode:
+                if 'ftp' not in imports:
+                    print "Streaming to ftp needs the ftplib module."
+                    return False
+                try:
+                    self.ftpStream = self.ftpConnect(ftpHost,inAttr.get('username',self.props.get('ftp_username','')),
+                        inAttr.get('password',self.props.get('ftp_password','')),inAttr.get('ftpdir','bu'))
+                except ftplib.all_errors, why:
+                    print "Can't connect to ftp %s: %s" % (ftpHost,str(why))
+                    return False
+                self.setFTPOptions(inAttr)
+                opener = self.ftpStreamOpen
             if inFile:
-                self.curArchiveName = os.path.join(inDest,inFile+"_"+str(self.curZipInc)+".zip")
-                self.curZip = zipfile.ZipFile(self.curArchiveName,'w') # ,zipfile.ZIP_DEFLATED
-                self.archiveList.append(self.curArchiveName)
+                level = inAttr.get('level',self.props.get('archivelevel',None))
+                try:
+                    if level not in (None,''):
+                        level = int(level)
+                        if archiveFormat in ('zip','tar.gz','tar.xz') and not 0<=level<=9:
+                            raise ValueError("must be 0-9")
+                        if archiveFormat == 'tar.zst' and not 1<=level<=22:
+                            raise ValueError("must be 1-22")
+                    else:
+                        level = None
+                    if archiveFormat == 'zip':
+                        volumeSize = self.sizeValue(inAttr.get('volumesize',self.props.get('volumesize',600000000)),600000000)
+                        if level is None:
+                            level = zlib.Z_DEFAULT_COMPRESSION
+                        self.curZip = archiveWriter(os.path.join(inDest,inFile),volumeSize,self.archiveList,level,opener)
+                    elif archiveFormat in tarWriter.levels:
+                        if archiveFormat == 'tar.xz' and 'lzma' not in imports:
+                            print "The tar.xz format needs the lzma module (backports.lzma on Python 2)."
+                            return False
+                        if archiveFormat == 'tar.zst' and 'zstd' not in imports:
+                            print "The tar.zst format needs the zstandard module."
+                            return False
+                        self.curZip = tarWriter(os.path.join(inDest,inFile),archiveFormat,self.archiveList,level,opener)
+                    else:
+                        print "Unknown archive format: "+archiveFormat
+                        return False
+                except ValueError, why:
+                    print "Bad archive level %s: %s" % (str(level),str(why))
+                    return False
+                except (IOError, os.error), why:
+                    print "Can't create archive %s: %s" % (os.path.join(inDest,inFile),str(why))
+                    self.ftpStreamClose()
+                    return False
+                self.curArchiveName = self.curZip.curName
             if self.testMode:
                 print "zipping:"+inSrc+" recurse:"+str(recurse)+" to:"+self.curArchiveName
-            self.processDir(inSrc,recurse,inLog)
+            # With threads (attribute, property or --jobs) members are compressed in parallel
+            # and written to the archive by this thread in the order they were found
+            threads = self.attrInt(inAttr,'threads',1)
+            if threads>1 and archiveFormat == 'zip' and not self.testMode:
+                self.zipPool = workerPool(threads)
+            try:
+                self.processDir(inSrc,recurse,inLog)
+                if self.zipPool:
+                    self.zipPoolResults(True)
+            except uploadError, why:
+                # The upload is gone, so every remaining file would fail the same way
+                print "\nArchive upload failed, stopping zip %s: %s" % (self.curArchiveName,str(why))
+                if self.zipPool:
+                    self.zipPool.close()
+                    self.zipPool = None
+                self.curZip.abort()
+                self.ftpStreamClose()
+                self.zipManifest = None
+                return False
             if self.props['archiveFile']:
-                self.curZip.close()
+                try:
+                    self.curZip.close()
+                except (IOError, os.error), why:
+                    print "Can't finish archive %s: %s" % (self.curArchiveName,str(why))
+                    self.ftpStreamClose()
+                    return False
+            self.ftpStreamClose()
+            if self.zipManifest is not None:
+                self.endArchiveManifest(os.path.join(inDest,inFile))
+
+    def ftpStreamClose(self):
+        if self.ftpStream:
+            try:
+                self.ftpStream.quit()
+            except ftplib.all_errors:
+                self.ftpStream.close()
+            self.ftpStream = None
 
+    # Set up the archive manifest for mode='full', 'incremental' or 'differential'. The state is kept
+    # in manifests named after the base attribute (default dest/.tc_archive): base.full.xml holds the
+    # tree as of the last full archive and base.last.xml as of the last archive of any kind.
+    # Incremental archives files changed since base.last.xml, differential since base.full.xml.
+    def beginArchiveManifest(self,inSrc,inDest,archiveMode,inAttr):
+        if archiveMode not in ('full','incremental','differential'):
+            print "Unknown archive mode: "+archiveMode
+            return False
+        self.zipBase = self.replaceTags(inAttr.get('base',self.props.get('archivebase',os.path.join(inDest,'.tc_archive'))))
+        self.zipBaseManifest = {}
+        if archiveMode != 'full':
+            if archiveMode == 'incremental':
+                compareName = self.zipBase+'.last.xml'
+            else:
+                compareName = self.zipBase+'.full.xml'
+            self.zipBaseManifest = self.loadManifest(compareName)
+            if not self.zipBaseManifest:
+                print "No base manifest %s, making a full archive." % compareName
+                archiveMode = 'full'
+        self.zipMode = archiveMode
+        self.zipSrc = os.path.abspath(inSrc)
+        self.zipChecksum = self.attrFlag(inAttr,'checksum')
+        self.zipManifest = {}
+        self.zipArchived = {}
+        return True
+
+    # Note an archived file in the manifests, with the CRC the writer computed while adding it
+    def zipRecord(self,record,member):
+        if record is None:
+            return
+        (key,entry) = record
+        entry['crc'] = "%08x" % (member.CRC & 0xffffffff)
+        entry['archive'] = os.path.basename(self.curZip.curName)
+        self.zipManifest[key] = entry
+        self.zipArchived[key] = entry
+
+    # Write the manifest of this archive next to it (name_manifest.xml) and move the base manifests on.
+    # Files that failed to archive are left out, so the next run picks them up again.
+    def endArchiveManifest(self,archivePath):
+        self.saveManifest(self.zipArchived,archivePath+"_manifest.xml",self.zipSrc)
+        if self.zipMode == 'full':
+            self.saveManifest(self.zipManifest,self.zipBase+'.full.xml',self.zipSrc)
+        self.saveManifest(self.zipManifest,self.zipBase+'.last.xml',self.zipSrc)
+        print "\nArchived "+str(len(self.zipArchived))+" of "+str(len(self.zipManifest))+" files ("+self.zipMode+")"
+        self.zipManifest = None
+
+    # Queue a file for compression on the zip pool and write out the members that are ready
+    def queueZipFile(self,inPath,zipType,fileStat,record=None):
+        if fileStat.st_size <= self.zipInlineSize:
+            self.zipPool.submit(self.curZip.compressFile,(inPath,zipType),(inPath,zipType,fileStat,record))
+        else:
+            # Too big to hold in memory, so it only keeps its place in line and is streamed when its turn comes
+            self.zipPool.submit(lambda: None,(),(inPath,zipType,fileStat,record))
+        self.zipPoolResults()
+
+    # Write compressed members to the archive in the order they were queued
+    def zipPoolResults(self,wait=False):
+        if wait:
+            results = self.zipPool.close()
+            self.zipPool = None
+        else:
+            results = self.zipPool.results()
+        for (inPath,zipType,fileStat,record),ok,value in results:
+            try:
+                if not ok:
+                    raise value
+                if value is None:
+                    member = self.curZip.addFile(inPath,None,zipType,fileStat)
+                else:
+                    member = self.curZip.addCompressed(inPath,None,zipType,fileStat,value)
+                self.zipRecord(record,member)
+            except uploadError:
+                raise
+            except (IOError, os.error), why:
+                print "Can't copy %s to %s: %s" % (inPath, '', str(why))
+            self.zipVolumeCheck()
+
+    def zipVolumeCheck(self):
+        if self.curArchiveName != self.curZip.curName:
+            self.curArchiveName = self.curZip.curName
+            self.report("Starting volume:"+self.curArchiveName)
+
+    # Send files over SSH: src is a directory or a file list (as written by createlist), dest is
+    # [user@]host:path. All files go over one SSH connection with threads (default 4) channels: SFTP
+    # channels on one paramiko session when paramiko is installed, otherwise sftp batch processes
+    # sharing an OpenSSH ControlMaster connection. port, identity (key file) and password are optional;
+    # base is stripped from list entries to give their remote paths.
     def taskSCP(self,inAttr):
-        if sys.platform == "darwin":
-            scpName = "scp"
-        elif sys.platform == "win32":
-            scpName = "pscp"
-        elif sys.platform.find("linux") != -1:
-            scpName = "scp"
+        src = self.replaceTags(inAttr.get('src','') or inAttr.get('filelist',''))
+        dest = self.replaceTags(inAttr.get('dest',''))
+        (target,sep,remotePath) = dest.partition(':')
+        if not src or not target or not sep:
+            print "scp needs a src directory or file list and a dest of [user@]host:path."
+            return False
+        (user,sep,host) = target.rpartition('@')
+        port = self.attrInt(inAttr,'port',22)
+        identity = inAttr.get('identity','')
+        threads = self.attrInt(inAttr,'threads',4)
+        fileList = None
+        if not os.path.isdir(src):
+            fileList = self.getFileList(src,inAttr.get('delimiter',self.props.get('delimiter','')))
+            if not fileList:
+                return False
+        sendList = self.scpFileList(src,fileList,inAttr.get('base',''),remotePath)
+        self.setThrottle(inAttr)
+        print "\nStarting scp to "+dest+"..."
+        if 'paramiko' in imports and not self.attrFlag(inAttr,'openssh'):
+            (i,failed) = self.scpParamiko(sendList,host,user,port,identity,inAttr.get('password',''),threads)
+        else:
+            (i,failed) = self.scpOpenSSH(sendList,target,port,identity,threads)
+        print "\nSent "+str(i)+" files to "+dest
+        if failed:
+            print str(failed)+" files failed"
+        return not failed
+
+    # (local path, remote path) pairs for the tree in src or, if fileList is given, its entries, read lazily
+    def scpFileList(self,src,fileList,base,remotePath):
+        remotePath = remotePath.rstrip('/') or '.'
+        if fileList is None:
+            for curPath,dirs,files in os.walk(src):
+                if self.ignoreSVN and '.svn' in dirs:
+                    dirs.remove('.svn')
+                relDir = self.relativePath(src,curPath)
+                for inName in files:
+                    yield (os.path.join(curPath,inName),remotePath+'/'+self.manifestKey(os.path.join(relDir,inName)))
         else:
-            scpName = "scp"
-
-        portStr = "10018"
-        srcPath = "add_to_favorites.php"
-        destUser = "root"
-        destURL = "stage.apmmusic.com"
-        destPath = "/var/www/html/testapm/myapm/"
-        sendStr = scpName + " -P " + portStr + " " + srcPath + " " + destUser + "@" + destURL + ":" + destPath
-        print sendStr
-        srcPath = "/var/www/html/testapm/myapm/add_to_favorites.php"
-        destPath = "add_to_favorites.php"
-        receiveStr = scpName + " -P " + portStr + " " + destUser + "@" + destURL + ":" + srcPath + " " + destPath
-        print receiveStr
+            for curFile in fileList:
+                if len(curFile)>0:
+                    relPath = self.relativePath(base,curFile) if base else curFile
+                    yield (curFile,remotePath+'/'+self.manifestKey(archiveName(relPath)))
+
+    # Send over one paramiko SSH session. Each upload thread opens its own SFTP channel on it.
+    def scpParamiko(self,sendList,host,user,port,identity,password,threads):
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        try:
+            client.connect(host,port,user or None,password or None,key_filename=identity or None)
+        except (paramiko.SSHException, IOError, os.error), why:
+            print "Can't connect to %s: %s" % (host,str(why))
+            return (0,1)
+        transport = client.get_transport()
+        channels = threading.local()
+        openChannels = []
+        madeDirs = {}
+        dirLock = threading.Lock()
+        def sendFile(inPath,remoteName):
+            if not hasattr(channels,'sftp'):
+                channels.sftp = paramiko.SFTPClient.from_transport(transport)
+                openChannels.append(channels.sftp)
+            sftp = channels.sftp
+            remoteDir = remoteName.rsplit('/',1)[0]
+            dirLock.acquire()
+            try:
+                if remoteDir not in madeDirs:
+                    parts = remoteDir.split('/')
+                    for i in range(1,len(parts)+1):
+                        curDir = '/'.join(parts[:i])
+                        if curDir and curDir not in madeDirs:
+                            try:
+                                sftp.stat(curDir)
+                            except IOError:
+                                sftp.mkdir(curDir)
+                            madeDirs[curDir] = 1
+            finally:
+                dirLock.release()
+            self.throttleFiles()
+            sent = [0]
+            def progress(done,total):
+                self.throttleBytes(done-sent[0])
+                sent[0] = done
+            sftp.put(inPath,remoteName,progress)
+        jobs = workerPool(threads)
+        i = 0
+        failed = 0
+        try:
+            for inPath,remoteName in sendList:
+                self.report("Sending "+inPath)
+                jobs.submit(sendFile,(inPath,remoteName),inPath)
+                for inPath,ok,value in jobs.results():
+                    if ok:
+                        i += 1
+                    else:
+                        print "Can't send %s: %s" % (inPath,str(value))
+                        failed += 1
+            for inPath,ok,value in jobs.close():
+                if ok:
+                    i += 1
+                else:
+                    print "Can't send %s: %s" % (inPath,str(value))
+                    failed += 1
+        finally:
+            for sftp in openChannels:
+                sftp.close()
+            client.close()
+        return (i,failed)
+
+    # Quote a path for an sftp batch file
+    def sftpQuote(self,inPath):
+        return '"'+inPath.replace('\\','\\\\').replace('"','\\"')+'"'
+
+    # Send over an OpenSSH ControlMaster connection: one master does the handshake, then threads sftp
+    # batch processes run as channels on it and get the files round-robin through their stdin.
+    # A batch stops at its first failed put, so the files after it on that channel count as failed.
+    def scpOpenSSH(self,sendList,target,port,identity,threads):
+        controlDir = tempfile.mkdtemp()
+        sshOptions = ['-o','ControlPath='+os.path.join(controlDir,'master'),'-o','Port='+str(port)]
+        if identity:
+            sshOptions += ['-i',identity]
+        try:
+            exitCode = subprocess.call(['ssh','-MNf','-o','ControlMaster=yes','-o','ControlPersist=yes']+sshOptions+[target])
+        except os.error, why:
+            print "Can't run ssh: "+str(why)
+            os.rmdir(controlDir)
+            return (0,1)
+        if exitCode:
+            print "Can't connect to %s: ssh exited with status %d" % (target,exitCode)
+            os.rmdir(controlDir)
+            return (0,1)
+        devNull = open(os.devnull,'w')
+        channels = []
+        try:
+            for n in range(max(1,threads)):
+                proc = subprocess.Popen(['sftp','-b','-']+sshOptions+[target],stdin=subprocess.PIPE,stdout=devNull)
+                channels.append({'proc':proc,'files':0,'dirs':{}})
+            n = 0
+            for inPath,remoteName in sendList:
+                channel = channels[n % len(channels)]
+                n += 1
+                self.report("Sending "+inPath)
+                commands = []
+                parts = remoteName.split('/')[:-1]
+                for i in range(1,len(parts)+1):
+                    curDir = '/'.join(parts[:i])
+                    if curDir and curDir not in channel['dirs']:
+                        # '-' lets the batch go on when the directory already exists
+                        commands.append("-mkdir "+self.sftpQuote(curDir))
+                        channel['dirs'][curDir] = 1
+                commands.append("put "+self.sftpQuote(inPath)+" "+self.sftpQuote(remoteName))
+                try:
+                    channel['proc'].stdin.write("\n".join(commands)+"\n")
+                    channel['files'] += 1
+                except IOError:
+                    # The batch has already stopped
+                    channel['files'] += 1
+        finally:
+            i = 0
+            failed = 0
+            for channel in channels:
+                try:
+                    channel['proc'].stdin.close()
+                except IOError:
+                    pass
+                if channel['proc'].wait():
+                    print "An sftp channel failed; up to %d of its files were not sent" % channel['files']
+                    failed += channel['files']
+                else:
+                    i += channel['files']
+            devNull.close()
+            subprocess.call(['ssh','-O','exit']+sshOptions+[target])
+            if os.path.isdir(controlDir):
+                shutil.rmtree(controlDir,True)
+        return (i,failed)
 
     def mysqlConnect(self):
         try:
@@ -1091,8 +3908,7 @@ class todocopy:
 
             cmdStr = os.path.normpath(pathMySQL)+" -h "+self.props['db_host']+" -u "+self.props['db_username']+" -p"+self.props['db_password']+" -P"+str(self.props['db_port'])+dbSelect+" < "+loadFile
             #print cmdStr
-            returnArray = self.doExec(cmdStr)
-            print ''.join(returnArray)
+            self.execStream(cmdStr)
 
 
     def taskDBProfile(self,inAttr=None):
@@ -1254,8 +4070,7 @@ class todocopy:
                     pathMySQL = os.path.normpath(os.path.join(self.props['path_mysql'],'mysql'))
                     importCmd = pathMySQL + " -h " + self.props['db_host'] + " -u " + self.props['db_username'] + " -p" + self.props['db_password'] + " --database=" + self.props['db_name'] + " < " + filename
                     #print importCmd
-                    returnArray = self.doExec(importCmd)
-                    print ''.join(returnArray)
+                    self.execStream(importCmd)
                     #os.system(importCmd)
                     if filename[0:2] == "sp" or filename[0:2] == "fn":
                         spName = filename[:-4]
@@ -1334,8 +4149,7 @@ class todocopy:
         pathMySQLDump = os.path.normpath(os.path.join(self.props['path_mysql'],'mysqldump'))
         cmdStr = pathMySQLDump+" -h "+self.props['db_host']+" -u "+self.props['db_username']+" -p"+self.props['db_password']+" -P"+str(self.props['db_port'])+noData+socketStr+" --databases "+self.props['db_name']+" "+dumpTables+dumpFile+extInsert+skipLocks+compressSend+tabDir+pipeDir
         print "\n"+cmdStr+"\n"
-        returnArray = self.doExec(cmdStr)
-        print ''.join(returnArray)
+        self.execStream(cmdStr)
 
     def  taskDBImport(self,inAttr=None):
         importFiles = inAttr.get('path','')
@@ -1363,8 +4177,7 @@ class todocopy:
             pathMySQL = os.path.join(self.props['path_mysql'],'mysqlimport')
             cmdStr = os.path.normpath(pathMySQL)+destHost+destUsername+destPassword+destPort+destSocket+" "+self.props['dest_db_name']+" "+importFiles
             #print cmdStr
-            returnArray = self.doExec(cmdStr)
-            print ''.join(returnArray)
+            self.execStream(cmdStr)
 
 # -----------------------------  End Tasks -----------------------------
 
@@ -1372,33 +4185,46 @@ class todocopy:
         if self.testMode:
             pass
             #print "Processing file:"+inDir+inFile
-        if self.props['archiveFile']:
-            if self.testExtension(inFile):
-                zipType = zipfile.ZIP_STORED
-            else:
-                zipType = zipfile.ZIP_DEFLATED
-            #self.curZip = zipfile.ZipFile(archivePath+archiveFile+"_"+str(self.curZipInc)+".zip",'w')
-            archiveSize = os.stat(self.curArchiveName).st_size
-            oneMeg = 1000000
-            oneGig = 1000 * oneMeg
-            fileLimit = 600 * oneMeg
-            if archiveSize - fileLimit > 1:
-                self.curZip.close()
-                self.curZipInc += 1
-                self.curArchiveName = os.path.join(self.props['destPath'],self.props['archiveFile']+"_"+str(self.curZipInc)+".zip")
-                self.curZip = zipfile.ZipFile(self.curArchiveName,'w',zipfile.ZIP_DEFLATED)
-                self.archiveList.append(self.curArchiveName)
-                print archiveSize,
+        zipType = zipfile.ZIP_DEFLATED
         if self.testMode:
             print "Zipping file:"+os.path.join(inDir,inFile)
         else:
+            self.throttleFiles()
             try:
                 inDir = inDir.encode('ascii','ignore')
                 inFile = inFile.encode('ascii','ignore')
-                self.curZip.write(os.path.join(inDir,inFile),None,zipType)
+                inPath = os.path.join(inDir,inFile)
+                # The archive writer splits volumes from its own byte count, so this is the only stat per file
+                fileStat = os.stat(inPath)
+                record = None
+                if self.zipManifest is not None:
+                    key = self.manifestKey(self.relativePath(self.zipSrc,inPath))
+                    oldEntry = self.zipBaseManifest.get(key)
+                    (entry,isChanged) = self.manifestEntry(inPath,oldEntry,self.zipChecksum,fileStat,False)
+                    if not isChanged:
+                        # Remember which archive still holds the unchanged file
+                        if 'archive' in oldEntry:
+                            entry['archive'] = oldEntry['archive']
+                        self.zipManifest[key] = entry
+                        return ''
+                    record = (key,entry)
+                # Only zip members can be stored; tar formats compress the whole stream
+                if self.props['archiveFile'] and isinstance(self.curZip,archiveWriter):
+                    if self.testCompressed(inPath,fileStat.st_size):
+                        zipType = zipfile.ZIP_STORED
+                self.throttleBytes(fileStat.st_size)
+                if self.zipPool:
+                    self.queueZipFile(inPath,zipType,fileStat,record)
+                else:
+                    member = self.curZip.addFile(inPath,None,zipType,fileStat)
+                    self.zipRecord(record,member)
+                    self.zipVolumeCheck()
+                    return "%08x" % (member.CRC & 0xffffffff)
+            except uploadError:
+                raise
             except (IOError, os.error), why:
                 print "Can't copy %s to %s: %s" % (os.path.join(inDir,inFile), '', str(why))
-        return zlib.crc32(inFile)
+        return ''
 
     def processDir(self,inDir,recurse=False,inLog=False):
         self.returnStr = ""
@@ -1452,7 +4278,7 @@ class todocopy:
                 self.curZip.close()
         if self.cmdOptions.ftpdest:
             print "\nStarting ftp to "+self.cmdOptions.ftpdest+"..."
-            self.ftpArchiveList(self.cmdOptions.ftpdest,"root","mypassword")
+            self.ftpArchiveList(self.archiveList,self.cmdOptions.ftpdest,self.props.get('ftp_username',''),self.props.get('ftp_password',''))
         # TODO: Activate the command line Task
         if self.cmdOptions.ftpdest == 'task':
             curType = 'svn'
@@ -1475,34 +4301,241 @@ class todocopy:
                 return defaultVal
         except:
             return ''
-    # Execute each command in the XML batch script
+    # Read a comma-separated list of target names from a target attribute (or its older alternative name)
+    def targetNames(self,target,attrName,altName):
+        names = []
+        nameStr = self.getAttr(target,attrName,self.getAttr(target,altName,''))
+        for name in self.replaceTags(nameStr).split(','):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+        return names
+
+    # Build the dependency graph of the targets reachable from rootNames. Returns the targets in the order
+    # they were found and a dict of the targets each one waits for: its depends/execbefore targets, the
+    # targets that name it in execafter/default, and the execafter targets of the ones it depends on
+    # (a target isn't finished until the targets it runs afterwards are).
+    def targetGraph(self,rootNames):
+        found = []
+        before = {}
+        after = {}
+        missing = []
+        pending = list(rootNames)
+        while pending:
+            name = pending.pop(0)
+            if name in before or name in missing:
+                continue
+            if name not in self.targetList:
+                print "Could not find target:"+name
+                missing.append(name)
+                continue
+            found.append(name)
+            before[name] = self.targetNames(self.targetList[name],'execbefore','depends')
+            after[name] = self.targetNames(self.targetList[name],'execafter','default')
+            pending.extend(before[name]+after[name])
+        for name in found:
+            before[name] = [n for n in before[name] if n in before]
+            after[name] = [n for n in after[name] if n in before]
+        def afterClosure(name,seen):
+            for nextName in after[name]:
+                if nextName not in seen:
+                    seen.append(nextName)
+                    afterClosure(nextName,seen)
+            return seen
+        waitFor = {}
+        for name in found:
+            waitFor[name] = list(before[name])
+            for other in found:
+                if name in after[other]:
+                    waitFor[name].append(other)
+            for preName in before[name]:
+                waitFor[name].extend(afterClosure(preName,[]))
+            waits = []
+            for preName in waitFor[name]:
+                if preName not in waits and not (preName==name and name not in before[name]):
+                    waits.append(preName)
+            waitFor[name] = waits
+        return found,waitFor
+
+    # Order the targets so each comes after the ones it waits for. Returns None if they form a cycle.
+    def targetOrder(self,found,waitFor):
+        order = []
+        state = {}
+        path = []
+        def visit(name):
+            if state.get(name) == 'done':
+                return True
+            if state.get(name) == 'visiting':
+                cycle = path[path.index(name):]+[name]
+                print "*** Error: target dependency cycle: "+" -> ".join(cycle)+" ***"
+                return False
+            state[name] = 'visiting'
+            path.append(name)
+            for preName in waitFor[name]:
+                if not visit(preName):
+                    return False
+            path.pop()
+            state[name] = 'done'
+            order.append(name)
+            return True
+        for name in found:
+            if not visit(name):
+                return None
+        return order
+
+    # A shallow copy of this todocopy for a task or target running on its own thread. It has its own props
+    # and tags, so concurrent tasks (e.g. a mysql dump and a zip) don't overwrite each other's settings.
+    def workerState(self):
+        worker = copy.copy(self)
+        worker.props = dict(self.props)
+        worker.tags = dict(self.tags)
+        # Connections and pools belong to the task that opened them
+        worker.mysqlconn = None
+        worker.copyPool = None
+        worker.zipPool = None
+        worker.curZip = None
+        return worker
+
+    # Copy the props and tags a finished target changed back, so the targets that depend on it see them
+    def mergeState(self,worker,props,tags):
+        for key,value in worker.props.items():
+            if key not in props or props[key] != value:
+                self.props[key] = value
+        for key,value in worker.tags.items():
+            if key not in tags or tags[key] != value:
+                self.tags[key] = value
+
+    # Run the targets in rootNames with everything they depend on, each target once and in dependency order.
+    # Independent targets run at the same time on the targetworkers property (or the project's workers
+    # attribute, default 1), each on its own workerState; a target's props and tags are merged back when it
+    # finishes. With one worker the targets run in turn on this object. When a target fails, the targets
+    # that depend on it are skipped. With onfailure 'stop' (the default) no new targets are started either;
+    # with 'continue' the independent ones still run.
+    def runTargets(self,rootNames):
+        found,waitFor = self.targetGraph(rootNames)
+        order = self.targetOrder(found,waitFor)
+        if order is None:
+            return False
+        workers = max(1,self.attrInt({},'targetworkers',1))
+        keepGoing = str(self.props.get('onfailure','stop')).lower() == 'continue'
+        position = {}
+        dependents = {}
+        remaining = {}
+        for i in range(len(order)):
+            name = order[i]
+            position[name] = i
+            remaining[name] = 0
+            for preName in waitFor[name]:
+                dependents.setdefault(preName,[]).append(name)
+                if preName not in self.targetsRun:
+                    remaining[name] += 1
+        def skip(name,failedName):
+            for depName in dependents.get(name,[]):
+                if depName not in self.targetsRun:
+                    print "Skipping target "+depName+": depends on failed target "+failedName
+                    self.targetsRun[depName] = False
+                    skip(depName,failedName)
+        for name in order:
+            for preName in waitFor[name]:
+                if self.targetsRun.get(preName) is False and name not in self.targetsRun:
+                    print "Skipping target "+name+": depends on failed target "+preName
+                    self.targetsRun[name] = False
+                    skip(name,preName)
+        ready = [name for name in order if remaining[name]==0 and name not in self.targetsRun]
+        jobs = Queue.Queue()
+        done = Queue.Queue()
+        threads = []
+        if workers>1:
+            for i in range(min(workers,len(order))):
+                thread = threading.Thread(target=self.targetWorker,args=(jobs,done))
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+        running = 0
+        failed = []
+        try:
+            while ready or running:
+                while ready and running<workers and (keepGoing or not failed):
+                    name = ready.pop(0)
+                    running += 1
+                    if threads:
+                        worker = self.workerState()
+                        jobs.put((name,worker,dict(worker.props),dict(worker.tags)))
+                    else:
+                        done.put(self.runTarget(name,self,False)+(self,None,None))
+                if not running:
+                    break
+                try:
+                    (name,ok,why,worker,props,tags) = done.get(True,0.5)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                if worker is not self:
+                    self.mergeState(worker,props,tags)
+                self.targetsRun[name] = ok
+                if not ok:
+                    failed.append(name)
+                    print "\n*** Error: target "+name+" failed: "+str(why)+" ***\n"
+                    skip(name,name)
+                    continue
+                for depName in dependents.get(name,[]):
+                    remaining[depName] -= 1
+                    if remaining[depName]==0 and depName not in self.targetsRun:
+                        ready.append(depName)
+                ready.sort(key=position.get)
+        except KeyboardInterrupt:
+            # Stop the commands the running targets are waiting on
+            self.cancelEvent.set()
+            raise
+        finally:
+            for thread in threads:
+                jobs.put(None)
+            for thread in threads:
+                # Join in steps so a second Ctrl-C still gets through
+                while thread.isAlive():
+                    thread.join(0.5)
+        if failed and ready:
+            print "Not started after the failure: "+", ".join(ready)
+        return len(failed)==0
+
+    def targetWorker(self,jobs,done):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            (name,worker,props,tags) = job
+            done.put(self.runTarget(name,worker,True)+(worker,props,tags))
+
+    # Run one target on worker. Returns (name,ok,reason it failed)
+    def runTarget(self,name,worker,announce):
+        startTime = time.time()
+        if announce:
+            sys.stdout.write("--> Starting target "+name+"\n")
+        why = "a task failed or the script was aborted"
+        try:
+            ok = worker.executeScript(self.targetList[name],'target')
+        except Exception, why:
+            ok = False
+        if announce and ok:
+            sys.stdout.write("--> Finished target %s in %.1fs\n" % (name,time.time()-startTime))
+        return (name,ok,why)
+
+    # Execute each command in the XML batch script. For the project, the targets named in its default
+    # (or on the command line) are then run with runTargets. Returns False if the script was aborted.
     def executeScript(self,xmlDOM,parentName='project',targetDefault=''):
         #print "Starting executeScript"
         if parentName=='project':
             execStartTime = strftime("%H:%M")
-        #targetParent = xmlDOM.getElementsByTagName(parentName).item(0)
-        #print xmlDOM.getElementsByTagName(parentName)
-        if len(targetDefault)==0:
-            targetDefault = self.getAttr(xmlDOM,'default','')
-
-        # Check if there is a target that needs to be executed before this one
-        execBeforeStr = self.getAttr(xmlDOM,'depends','')
-        execBeforeStr = self.getAttr(xmlDOM,'execbefore',execBeforeStr)
-        execBeforeStr = self.replaceTags(execBeforeStr)
-        if(len(execBeforeStr)>0):
-            execBeforeArray = execBeforeStr.split(',')
-            for execBefore in execBeforeArray:
-                if(len(execBefore)>0 and execBefore in self.targetList):
-                    # If new target has a default, set it for the recursive call
-                    defaultInTarget = self.getAttr(self.targetList[execBefore],'default','')
-                    # Check the other names that this attribute might be under
-                    defaultInTarget = self.getAttr(self.targetList[execBefore],'execafter',defaultInTarget)
-                    #print "Executing before:"+execBefore
-                    defaultInTarget = self.replaceTags(defaultInTarget)
-                    self.executeScript(self.targetList[execBefore],'target',defaultInTarget)
-                else:
-                    print "Could not find target:"+execBefore
-
+            if len(targetDefault)==0:
+                targetDefault = self.getAttr(xmlDOM,'default','')
+            if self.getAttr(xmlDOM,'workers',''):
+                self.props['targetworkers'] = self.getAttr(xmlDOM,'workers','')
+            if self.getAttr(xmlDOM,'onfailure',''):
+                self.props['onfailure'] = self.getAttr(xmlDOM,'onfailure','')
+            # Check if there are targets that need to be executed before the project
+            execBefore = self.targetNames(xmlDOM,'execbefore','depends')
+            if execBefore and not self.runTargets(execBefore):
+                return False
 
         #targetDefault = xmlDOM.getElementsByTagName(parentName).item(0).getAttribute('default')
         targets = xmlDOM.childNodes
@@ -1528,17 +4561,48 @@ class todocopy:
                         if self.testMode:
                             print self.curSpaces+"Copy src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')
                         else:
-                            self.taskCopy({'src':target.getAttribute('src'),'dest':target.getAttribute('dest')})
+                            attrList['src'] = target.getAttribute('src')
+                            attrList['dest'] = target.getAttribute('dest')
+                            self.taskCopy(attrList)
+                    elif curType == 'copylist':
+                        if self.testMode:
+                            print self.curSpaces+"Copylist filelist:"+target.getAttribute('filelist')+" dest:"+target.getAttribute('dest')
+                        else:
+                            attrList['filelist'] = self.replaceTags(target.getAttribute('filelist'))
+                            attrList['dest'] = target.getAttribute('dest')
+                            self.taskCopyList(attrList)
+                    elif curType == 'extract' or curType == 'restore':
+                        if self.testMode:
+                            print self.curSpaces+curType+" src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')
+                        else:
+                            self.taskExtract(attrList)
+                    elif curType == 'scp' or curType == 'sftp':
+                        if self.testMode:
+                            print self.curSpaces+curType+" src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')
+                        else:
+                            self.taskSCP(attrList)
+                    elif curType == 'verify':
+                        if self.testMode:
+                            print self.curSpaces+"verify src:"+target.getAttribute('src')
+                        else:
+                            self.taskVerify(attrList)
+                    elif curType == 'snapshot':
+                        if self.testMode:
+                            print self.curSpaces+"snapshot src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')
+                        else:
+                            self.taskSnapshot(attrList)
                     elif curType == 'ftp':
                         #self.props['srcPath'] = self.replaceTags(str(self.props['srcPath']))
                         if self.testMode:
                             print self.curSpaces+"ftp src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')
-                        self.taskFTP(self.props['srcPath'],target.getAttribute('dest'),target.getAttribute('username'),target.getAttribute('password'))
+                        self.setThrottle(attrList)
+                        self.taskFTP(self.replaceTags(attrList.get('src','')),target.getAttribute('dest'),target.getAttribute('username'),target.getAttribute('password'),attrList)
                     elif curType == 'zip':
                         self.props['archiveFile'] = self.replaceTags(str(target.getAttribute('archiveFile')))
                         if self.testMode:
                             print self.curSpaces+"zip src:"+target.getAttribute('src')+" dest:"+target.getAttribute('dest')+" archiveFile:"+target.getAttribute('archiveFile')
-                        self.taskZip(self.props['srcPath'],self.props['destPath'],self.props['archiveFile'])
+                        self.setThrottle(attrList)
+                        self.taskZip(self.props['srcPath'],self.props['destPath'],self.props['archiveFile'],True,False,attrList)
                     elif curType == 'pause':
                         if self.testMode:
                             print self.curSpaces+"pause"
@@ -1558,7 +4622,15 @@ class todocopy:
                     elif curType == 'exec':
                         if self.testMode:
                             print self.curSpaces+"exec"
-                        self.taskExec(target.attributes)
+                        if not self.taskExec(attrList) and self.attrFlag(attrList,'failonerror'):
+                            # Fail the target so the targets depending on it are skipped
+                            finished = True
+                    elif curType == 'parallel':
+                        if self.testMode:
+                            print self.curSpaces+"parallel"
+                        if not self.taskParallel(target):
+                            # Fail the target like a failing task would
+                            finished = True
                     elif curType == 'crontab':
                         if self.testMode:
                             print self.curSpaces+"crontab"
@@ -1635,23 +4707,16 @@ class todocopy:
                             tempTagVal =  self.replaceTags(tempTagVal)
                             print self.curSpaces+"set tag '" + target.getAttribute('name') + "' to " + tempTagVal
                             self.tags[target.getAttribute('name')] = tempTagVal
-        if(len(targetDefault)>0):
-            if(targetDefault in self.targetList):
-                # If target uses tags, replace them
-                targetDefault = self.replaceTags(targetDefault)
-                # If new target has a default, set it for the recursive call
-                defaultInTarget = self.getAttr(self.targetList[targetDefault],'default','')
-                # Check the other names that this attribute might be under
-                defaultInTarget = self.getAttr(self.targetList[targetDefault],'execafter',defaultInTarget)
-                defaultInTarget = self.replaceTags(defaultInTarget)
-                #print "Executing after:"+targetDefault
-                self.executeScript(self.targetList[targetDefault],'target',defaultInTarget)
-            else:
-                print "Could not find target:"+targetDefault
+        scriptOk = not finished
+        if parentName=='project' and not finished:
+            targetDefault = self.replaceTags(targetDefault)
+            if len(targetDefault)>0:
+                scriptOk = self.runTargets([name.strip() for name in targetDefault.split(',') if name.strip()])
 
         if not self.props['quietmode']:
             if parentName=='project':
                 print "Script execute complete. ST:"+execStartTime+" ET:"+strftime("%H:%M")
+        return scriptOk
 
     # Parse the XML batch file
     def loadScript(self,fName):
@@ -1667,6 +4732,24 @@ class todocopy:
 
         if options.quietmode:
             self.props['quietmode']=1
+        if options.incremental:
+            self.props['incremental'] = 1
+        if options.jobs:
+            self.props['threads'] = options.jobs
+        if options.delta:
+            self.props['delta'] = 1
+        if options.resume:
+            self.props['resume'] = 1
+        if options.tarmode:
+            self.props['copymode'] = 'tar'
+        if options.nuldelimited:
+            self.props['delimiter'] = 'nul'
+        if options.deleteorphans:
+            self.props['deleteorphans'] = 1
+        if options.username:
+            self.props['ftp_username'] = options.username
+        if options.password:
+            self.props['ftp_password'] = options.password
         if self.props['ignoresvndir']:
             if not self.props['quietmode']:
                 self.report("Ignoring SVN folders.")
@@ -1691,12 +4774,34 @@ class todocopy:
         self.addExample('',"python todocopy.py example_exec.xml target1","Execute target1 in XML script")
         self.registerCommand('copy',[self.taskCopy,['src',''],['dest','']])
         self.addExample('copy',	"todocopy.py copy ./ ../yhw_production","Copy files from -> to")
+        self.addExample('copy',	"todocopy.py copy ./ ../yhw_production --incremental","Copy only new or changed files")
+        self.addExample('copy',	"todocopy.py copy ./ ../yhw_production --jobs 8","Copy with 8 parallel threads")
+        self.addExample('copy',	"todocopy.py copy ./ ../yhw_production --tar","Stream a tree of many small files as one tar")
         self.registerCommand('copylist',[self.taskCopyList,['filelist',''],['dest','']])
         self.addExample('copylist',"todocopy.py copylist filelist.txt ../yhw_production","Copy all files in list with automatic path creation")
+        self.registerCommand('snapshot',[self.taskSnapshot,['src',''],['dest',''],['name','']])
+        self.addExample('snapshot',"todocopy.py snapshot ./ ../bu_store","Store a deduplicated snapshot of the current dir")
+        self.registerCommand('snaprestore',[self.taskSnapshotRestore,['src',''],['dest',''],['name','']])
+        self.addExample('snaprestore',"todocopy.py snaprestore ../bu_store ./restored","Restore the latest snapshot from a store")
+        self.registerCommand('verify',[self.taskVerify,['src',''],['manifest','']])
+        self.addExample('verify',"todocopy.py verify ../bu/MyDailyBU_092008","Test every member of every volume of an archive")
+        self.addExample('verify',"todocopy.py verify ../bu/MyDailyBU_092008 ../bu/MyDailyBU_092008_manifest.xml","Verify an archive and compare it with its manifest")
+        self.registerCommand('extract',[self.taskExtract,['src',''],['dest',''],['select','']])
+        self.registerCommand('restore',[self.taskExtract,['src',''],['dest',''],['select','']])
+        self.addExample('extract',"todocopy.py extract ../bu/MyDailyBU_092008 ./restored","Extract all volumes of an archive")
+        self.addExample('extract',"todocopy.py extract ../bu/MyDailyBU_092008 ./restored var/www/site1","Restore one directory from a split archive")
+        self.addExample('extract',"todocopy.py extract ../bu/MyDailyBU_092008 ./restored '*.php'","Restore only the files matching a glob")
         self.registerCommand('createlist',[self.taskCreateList,['src',''],['dest',''],['type','newline']])
         self.addExample('createlist',"todocopy.py createlist -r .","Display a list of all files (recursive) in the current dir")
         self.addExample('createlist',"todocopy.py createlist -r . filelist.txt","Output a list of all files (recursive) in the current dir")
+        self.addExample('createlist',"todocopy.py createlist -r . filelist.txt nul","Output a NUL-delimited list for names with newlines")
         self.registerCommand('ftplist',[self.taskFTPList,['filelist',''],['dest','']])
+        self.registerCommand('scp',[self.taskSCP,['src',''],['dest','']])
+        self.addExample('scp',"todocopy.py scp ./site deploy@web2:/var/www/site","Send a tree over one multiplexed SSH connection")
+        self.addExample('scp',"todocopy.py scp filelist.txt deploy@web2:/var/www/site --jobs 8","Send the files in a list on 8 SSH channels")
+        self.registerCommand('ftpsync',[self.taskFTPSync,['src',''],['dest','']])
+        self.addExample('ftpsync',"todocopy.py ftpsync ./site 205.107.10.199 -u backup -[ secret --delete-orphans","Upload only the files changed since the last sync")
+        self.addExample('ftplist',"todocopy.py ftplist filelist.txt 205.107.10.199 -u backup -[ secret --jobs 8","FTP all files in a list on 8 connections")
         self.addExample('ftp',"todocopy.py -l filelist.txt --ftp 205.107.10.199","FTP ")
         self.registerCommand('workingdir',[self.taskWorkingDir,['value','./']])
         self.registerCommand('dbsummary',[self.taskDBSummary,['tablelist','']])
@@ -1715,7 +4820,6 @@ class todocopy:
         self.registerCommand('findabove',[self.taskFindAbove,['src',''],['filename','']])
 
         # TODO: Replace these placeholders with real commands
-        self.registerCommand('scp',[self.taskSCP,['action',''],['dest','']])
         self.registerCommand('email',[self.taskFTPList,['filelist',''],['dest','']])
         self.registerCommand('log',[self.taskFTPList,['filelist',''],['dest','']])
 
@@ -1819,6 +4923,13 @@ if __name__ == '__main__':
     parser.add_option("-c", "--copydir", dest="copydir", help="Source directory of files to copy", metavar="COPYDIR")
     parser.add_option("-r", "--recursive",action="store_true", dest="recursive", default=False,help="Perform recursive operation")
     parser.add_option("-e", "--test",action="store_true", dest="testmode", default=False,help="Don't actually copy or create files")
+    parser.add_option("-i", "--incremental",action="store_true", dest="incremental", default=False,help="Copy only files changed since the destination manifest")
+    parser.add_option("--delete-orphans",action="store_true", dest="deleteorphans", default=False,help="With --incremental, delete destination files no longer in the source")
+    parser.add_option("--tar",action="store_true", dest="tarmode", default=False,help="Copy the tree as a single tar stream")
+    parser.add_option("--resume",action="store_true", dest="resume", default=False,help="Journal the copy so an interrupted run can continue where it stopped")
+    parser.add_option("--delta",action="store_true", dest="delta", default=False,help="Rewrite only the changed blocks of large existing files")
+    parser.add_option("-0", "--null",action="store_true", dest="nuldelimited", default=False,help="File lists are NUL-delimited")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs",help="Copy with JOBS parallel threads", metavar="JOBS")
     parser.add_option("-q", "--quiet",action="store_true", dest="quietmode", default=False,help="Turn off copyright messages")
     parser.add_option("-t", "--task", dest="tasktype", help="Task to execute (equivalent to XML tag)", metavar="TASKTYPE")
     parser.add_option("-u", "--username", dest="username", help="Set username", metavar="USERNAME")